@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 
-from app.core.models import Room, Task, Player, PlayerTask, Color
+from app.core.models import Room, Task, Player, PlayerTask, Color, UserStats, ArchivedRoom
 
 admin.site.site_header = 'YarDenBox Administration'
 
@@ -19,3 +19,5 @@ admin.site.register(get_user_model())
 admin.site.register(Player)
 admin.site.register(PlayerTask)
 admin.site.register(Color)
+admin.site.register(UserStats)
+admin.site.register(ArchivedRoom)
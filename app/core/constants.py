@@ -5,3 +5,6 @@ MIN_PLAYER_NUMBER = 2
 SCOPE_ORDER = 10
 ANSWERING_DURATION = 60
 VOTE_DURATION = 20
+LOBBY_COALESCE_WINDOW = 0.5
+HEARTBEAT_INTERVAL = 20
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
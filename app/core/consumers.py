@@ -1,186 +1,215 @@
-from random import shuffle
-
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
-from django.db.models import Count, F, Q
-from rest_framework_simplejwt import authentication
-
-from config.celery import app
-from app.core.constants import MIN_PLAYER_NUMBER, SCOPE_ORDER, ANSWERING_DURATION
-from app.core.models import Room, PlayerTask, Task, Player
-from app.core.tasks import send_delayed_message
-from app.core.utils import vote_event, greeting_event, error_event, start_event, define_event, group_by, winner_event, \
-    answer_accepted_event, connection_event, score_event, pause_event, resume_event, validate_event, simple_group
-
-
-# TODO try async consumer
-# TODO logging into file
-
-
-class RoomConsumer(JsonWebsocketConsumer):
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import JsonWebsocketConsumer, AsyncJsonWebsocketConsumer
+
+from app.core.constants import LOBBY_COALESCE_WINDOW, HEARTBEAT_INTERVAL
+from app.core.encoding import dumps, loads
+from app.core.fanout import send_many
+from app.core.heartbeat import heartbeat
+from app.core.lobby import LOBBY_GROUP, merge_diffs
+from app.core.metrics import EventStats
+from app.core.middleware import handshake_version
+from app.core.protocol import Outbox, RoomProtocol, GROUP_PREFIX
+from app.core.utils import error_event, connection_event, event_errors, lobby_event, is_alive_event
+
+logger = logging.getLogger(__name__)
+
+
+class RoomConsumer(RoomProtocol, AsyncJsonWebsocketConsumer):
+    """
+    Game room socket, authenticated during the handshake by JWTAuthMiddleware.
+    Sends an isAlive event every HEARTBEAT_INTERVAL seconds, the open socket and every event keep the player alive.
+    """
+    heartbeat_task = None
+    heartbeat_interval = HEARTBEAT_INTERVAL
+
+    async def connect(self):
+        player = self.scope.get('player')
+        if player is None:
+            await self.close()
+            return
+        stats = EventStats('connect')
+        self.room_name = self.scope['url_route']['kwargs']['room_name']
+        self.room_id = player.room_id
+        self.room_group_name = GROUP_PREFIX + self.room_name
+        with stats.layer():
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept(self.scope.get('subprotocol'))
+        await self.send_json(connection_event())
+        outbox = Outbox()
+        await database_sync_to_async(stats.counted(self.join))(outbox, player, handshake_version(self.scope))
+        await self.deliver(outbox, stats)
+        stats.observe()
+        self.heartbeat_task = asyncio.ensure_future(self.ping())
+
+    async def disconnect(self, code):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.player_id is None:
+            return
+        stats = EventStats('disconnect')
+        await database_sync_to_async(stats.counted(self.leave_room))()
+        with stats.layer():
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        stats.observe()
+
+    async def receive_json(self, data, **kwargs):
+        errors = event_errors(data)
+        if errors:
+            await self.send_json(error_event("Event isn't valid", errors))
+            return
+        logger.debug('Incoming event %s', data)
+        stats = EventStats(data['eventType'])
+        try:
+            outbox = await database_sync_to_async(stats.counted(self.handle_event))(data)
+        except Exception:
+            logger.exception('Event %s failed', data.get('eventType'))
+            return
+        await self.deliver(outbox, stats)
+        stats.observe()
+
+    async def deliver(self, outbox, stats):
+        for kind, payload in outbox.deliveries():
+            if kind == Outbox.REPLY:
+                await self.send(text_data=payload)
+            elif kind == Outbox.GROUP:
+                with stats.layer():
+                    await self.channel_layer.group_send(self.room_group_name, {'type': 'send_encoded',
+                                                                               'text': payload})
+            else:
+                with stats.layer():
+                    await send_many(self.channel_layer, [(channel_name, {'type': 'send_encoded', 'text': text})
+                                                         for channel_name, text in payload])
+
+    async def ping(self):
+        """
+        Refreshes the heartbeat while the socket is open, so an idle player is not reaped
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await sync_to_async(heartbeat.touch)(self.player_id)
+            await self.send_json(is_alive_event())
+
+    async def send_message(self, event):
+        await self.send_json(event.get('data'))
+
+    async def send_encoded(self, event):
+        await self.send(text_data=event['text'])
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return dumps(content)
+
+
+class LobbyConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Streams lobby diffs, coalesced by room over LOBBY_COALESCE_WINDOW seconds.
+    Authenticated by JWTAuthMiddleware like the lobby list.
+    """
+    flush_task = None
+
+    async def connect(self):
+        if self.scope.get('user') is None:
+            await self.close()
+            return
+        self.diffs = {}
+        self.version = 0
+        await self.channel_layer.group_add(LOBBY_GROUP, self.channel_name)
+        await self.accept(self.scope.get('subprotocol'))
+        await self.send_json(connection_event())
+
+    async def disconnect(self, code):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.channel_layer.group_discard(LOBBY_GROUP, self.channel_name)
+
+    async def lobby_diff(self, event):
+        merge_diffs(self.diffs, event['diff'])
+        self.version = max(self.version, event['version'])
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(LOBBY_COALESCE_WINDOW)
+        diffs, self.diffs, self.flush_task = self.diffs, {}, None
+        if diffs:
+            await self.send_json(lobby_event(list(diffs.values()), self.version))
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return dumps(content)
+
+
+class SyncRoomConsumer(RoomProtocol, JsonWebsocketConsumer):
+    """
+    Thread-pool version of RoomConsumer, kept for comparison benchmarks
+    """
     def connect(self):
+        player = self.scope.get('player')
+        if player is None:
+            self.close()
+            return
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_id = Room.objects.list_actual_rooms().get(name=self.room_name)
-        self.room_group_name = 'game_' + self.room_name
+        self.room_id = player.room_id
+        self.room_group_name = GROUP_PREFIX + self.room_name
         async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
-        self.accept()
+        self.accept(self.scope.get('subprotocol'))
         self.send_json(connection_event())
+        outbox = Outbox()
+        self.join(outbox, player, handshake_version(self.scope))
+        self.deliver(outbox)
 
     def disconnect(self, code):
-        player = Player.objects.get(id=self.player_id)
-        player.active = False
-        player.save(update_fields=('active',))
-        room = Room.objects.get(id=self.room_id)
-        if room.empty:
-            room.finish_work()
+        if self.player_id is None:
+            return
+        self.leave_room()
         async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
 
     def receive_json(self, data, **kwargs):
-        if not validate_event(data):
-            self.send_json(error_event("Event isn't valid"))
+        errors = event_errors(data)
+        if errors:
+            self.send_json(error_event("Event isn't valid", errors))
+            return
+        logger.debug('Incoming event %s', data)
+        try:
+            outbox = self.handle_event(data)
+        except Exception:
+            logger.exception('Event %s failed', data.get('eventType'))
             return
-        print(data)
-        event_type = data['eventType']
-        try:  # TODO drop in prod
-            if event_type == 'pause':
-                self.pause()
-            elif event_type == 'resume':
-                self.resume()
-            elif event_type == 'greeting':
-                self.greeting(data)
-            elif event_type == 'start':
-                self.start()
-            elif event_type == 'answer':
-                self.answer(data)
-            elif event_type == 'voteList':
-                self.vote(data)
-        except Exception as e:
-            print(e)
+        self.deliver(outbox)
+
+    def deliver(self, outbox):
+        for kind, payload in outbox.deliveries():
+            if kind == Outbox.REPLY:
+                self.send(text_data=payload)
+            elif kind == Outbox.GROUP:
+                async_to_sync(self.channel_layer.group_send)(self.room_group_name, {'type': 'send_encoded',
+                                                                                    'text': payload})
+            else:
+                async_to_sync(send_many)(self.channel_layer, [(channel_name, {'type': 'send_encoded', 'text': text})
+                                                              for channel_name, text in payload])
 
     def send_message(self, event):
         self.send_json(event.get('data'))
 
-    def send_delayed_message(self, event, delay):
-        # TODO save task id to db
-        task = send_delayed_message.apply_async(args=[self.room_group_name, event], countdown=delay)
-        return task
-
-    @staticmethod
-    def end_celery_message(task_id):
-        app.control.revoke(task_id, terminate=True)
-
-    def pause(self):
-        # TODO stop timer
-        async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-            'type': 'send_message',
-            'data': pause_event()
-        })
-
-    def resume(self):
-        # TODO resume timer
-        async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-            'type': 'send_message',
-            'data': resume_event()
-        })
-
-    def greeting(self, data):
-        token = authentication.JWTAuthentication().get_validated_token(data['token'])
-        user = authentication.JWTAuthentication().get_user(token)
-        player = Player.objects.get(user=user, room_id=self.room_id)
-        self.player_id = player.id
-        player.socket_channel_name = self.channel_name
-        player.active = True
-        player.save(update_fields=('socket_channel_name', 'active'))
-        room = Room.objects.get(id=self.room_id)
-        if room.status == Room.PENDING:
-            players = Player.objects.filter(room=room).values('id', 'username')
-            self.send_json(define_event(player.id, player.username, player.host))
-            async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-                'type': 'send_message',
-                'data': greeting_event(room.name, room.password, list(players))
-            })
-        else:
-            data = {}
-            if room.status == Room.ANSWERING:
-                data = start_event(group_by(player.questions(), 'questions', 'userId', 'username'))
-            elif room.status == Room.VOTING:
-                data = vote_event(group_by(player.answers(), 'answers', 'questionId', 'question'))
-            self.send_json(data)
-            if room.paused:
-                self.send_json(pause_event())
-            # send other reconnection event
-
-    def start(self):
-        room = Room.objects.get(id=self.room_id)
-        player_count = room.players.count()
-        if player_count < MIN_PLAYER_NUMBER:
-            self.send_json(error_event('Amount of users smaller than ' + str(MIN_PLAYER_NUMBER)))
-            return
-        all_tasks = Task.objects.exclude(playertasks__player__room=room)
-        if all_tasks.count() < player_count * room.max_round:
-            self.send_json(error_event('Not enough tasks for this game'))
-            return
-        room.start_work()
-        game_tasks = all_tasks.order_by('?').values_list('id', flat=True)[:player_count]
-        repetitive_tasks = game_tasks.copy()
-        repetitive_tasks.append(repetitive_tasks.pop(0))
-        players = list(room.players.values_list('id', flat=True))
-        shuffle(players)
-        scope_cost = room.current_round * (player_count - 1) * SCOPE_ORDER
-        for i in range(player_count):
-            PlayerTask.objects.create(task_id=game_tasks[i],
-                                      player_id=players[i],
-                                      round=room.current_round,
-                                      scope_cost=scope_cost)
-            PlayerTask.objects.create(task_id=repetitive_tasks[i],
-                                      player_id=players[i],
-                                      round=room.current_round,
-                                      scope_cost=scope_cost)
-        for channel_name, data in simple_group(room.active_tasks(), 'channel_name'):  # can move to celery
-            async_to_sync(self.channel_layer.send)(channel_name, {
-                'type': 'send_message',
-                'data': start_event(data)
-            })
-        tasks = room.tasks_for_vote()
-        self.send_delayed_message(vote_event(group_by(tasks, 'answers', 'questionId', 'question')), ANSWERING_DURATION)
-
-    def answer(self, data):
-        for answer in data['answer']:
-            PlayerTask.objects.get(player_id=self.player_id, task_id=answer['questionId']).set_answer(answer['answer'])
-        room = Room.objects.get(id=self.room_id)
-        players = room.responding_players()
-        data = [{'id': player_id, 'username': username} for ch, player_id, username in players]
-        for item in players:
-            async_to_sync(self.channel_layer.send)(item[0], {
-                'type': 'send_message',
-                'data': answer_accepted_event(data)
-            })
-        if not room.has_unfinished_tasks():
-            self.end_celery_message(room.timeout_task_id)
-            tasks = room.tasks_for_vote(self.player_id)
-            async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-                'type': 'send_message',
-                'data': vote_event(group_by(tasks, 'answers', 'questionId', 'question'))
-            })
-
-    def vote(self, data):
-        for vote in data['votes']:
-            PlayerTask.objects.get(task_id=vote['questionId'], player_id=vote['voteId']).likes.add(self.player_id)
-        room = Room.objects.get(id=self.room_id)
-        if room.has_no_unvoted_tasks():
-            PlayerTask.objects.filter(player__room=room, round=room.current_round) \
-                              .annotate(likes_count=Count('likes')) \
-                              .update(score=F('score') + F('likes_count') * SCOPE_ORDER)
-            if room.current_round == room.max_round:
-                player = room.players.  # djangoorm get object w
-                async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-                    'type': 'send_message',
-                    'data': winner_event(player.user.username)
-                })
-            else:
-                room.current_round += 1
-                room.save('current_round')
-                async_to_sync(self.channel_layer.group_send)(self.room_group_name, {
-                    'type': 'send_message',
-                    'data': score_event(Player.objects.scores(room))
-                })
+    def send_encoded(self, event):
+        self.send(text_data=event['text'])
+
+    @classmethod
+    def decode_json(cls, text_data):
+        return loads(text_data)
+
+    @classmethod
+    def encode_json(cls, content):
+        return dumps(content)
@@ -0,0 +1,32 @@
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def orjson_dumps(data):
+    return orjson.dumps(data).decode()
+
+
+def get_backend(name=None):
+    """
+    Returns dumps and loads of the JSON backend set by EVENT_JSON_BACKEND, the fastest installed one by default
+    """
+    name = name or getattr(settings, 'EVENT_JSON_BACKEND', None)
+    if name in (None, 'orjson') and orjson is not None:
+        return orjson_dumps, orjson.loads
+    if name in (None, 'ujson') and ujson is not None:
+        return ujson.dumps, ujson.loads
+    return json.dumps, json.loads
+
+
+dumps, loads = get_backend()
@@ -0,0 +1,71 @@
+from app.core.encoding import dumps, loads
+from app.core.storage import get_redis
+
+
+class EventLog:
+    """
+    Versioned log of the events sent to a room, a Redis sorted set scored by version.
+    Only the last SIZE events are kept, a client further behind gets a snapshot instead of a replay.
+    """
+    KEY_PREFIX = 'event_log:'
+    VERSION_KEY_PREFIX = 'event_log_version:'
+    SIZE = 256
+    TTL = 24 * 60 * 60
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def key(self, room_id):
+        return f'{self.KEY_PREFIX}{room_id}'
+
+    def version_key(self, room_id):
+        return f'{self.VERSION_KEY_PREFIX}{room_id}'
+
+    def version(self, room_id):
+        return int(self.connection.get(self.version_key(room_id)) or 0)
+
+    def append(self, room_id, entries):
+        """
+        Stores (player ids, event) entries, player ids are None for room-wide events.
+        Sets the version of every event in place, so it is sent with the event.
+        """
+        if not entries:
+            return
+        version = self.connection.incrby(self.version_key(room_id), len(entries)) - len(entries)
+        mapping = {}
+        for player_ids, event in entries:
+            version += 1
+            event['version'] = version
+            mapping[dumps({'to': player_ids, 'event': event})] = version
+        pipe = self.connection.pipeline()
+        pipe.zadd(self.key(room_id), mapping)
+        pipe.zremrangebyrank(self.key(room_id), 0, -self.SIZE - 1)
+        pipe.expire(self.key(room_id), self.TTL)
+        pipe.expire(self.version_key(room_id), self.TTL)
+        pipe.execute()
+
+    def since(self, room_id, version, player_id):
+        """
+        Returns the current version and the events of player_id after version,
+        events are None when the log no longer has all of them
+        """
+        pipe = self.connection.pipeline()
+        pipe.get(self.version_key(room_id))
+        pipe.zrange(self.key(room_id), 0, 0, withscores=True)
+        pipe.zrangebyscore(self.key(room_id), version + 1, '+inf')
+        current, oldest, entries = pipe.execute()
+        current = int(current or 0)
+        if version > current or version < current and (not oldest or oldest[0][1] > version + 1):
+            return current, None
+        entries = [loads(entry) for entry in entries]
+        return current, [entry['event'] for entry in entries if entry['to'] is None or player_id in entry['to']]
+
+    def clear(self, room_id):
+        self.connection.delete(self.key(room_id), self.version_key(room_id))
+
+
+event_log = EventLog()
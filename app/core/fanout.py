@@ -0,0 +1,50 @@
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+SEND_MANY_SCRIPT = """
+local count = #KEYS
+local over_capacity = 0
+for i = 1, count do
+    if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[count + i]) then
+        redis.call('LPUSH', KEYS[i], ARGV[i])
+        redis.call('EXPIRE', KEYS[i], ARGV[2 * count + 1])
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+async def send_many(channel_layer, messages):
+    """
+    Sends (channel name, message) pairs. With channels_redis it is one round trip per Redis server
+    instead of three per message, other layers get the messages one by one.
+    Specific channels are hashed by their non-local name like receive and group_send do.
+    """
+    if not isinstance(channel_layer, RedisChannelLayer):
+        for channel_name, message in messages:
+            await channel_layer.send(channel_name, message)
+        return
+    keys = defaultdict(list)
+    args = defaultdict(list)
+    capacities = defaultdict(list)
+    for channel_name, message in messages:
+        name = channel_name
+        if '!' in channel_name:
+            message = dict(message, __asgi_channel__=channel_name)
+            name = channel_layer.non_local_name(channel_name)
+        index = channel_layer.consistent_hash(name)
+        keys[index].append(channel_layer.prefix + name)
+        args[index].append(channel_layer.serialize(message))
+        capacities[index].append(channel_layer.get_capacity(channel_name))
+    over_capacity = 0
+    for index, index_keys in keys.items():
+        async with channel_layer.connection(index) as connection:
+            over_capacity += await connection.eval(SEND_MANY_SCRIPT, keys=index_keys,
+                                                   args=args[index] + capacities[index] +
+                                                   [int(channel_layer.expiry)])
+    if over_capacity:
+        raise ChannelFull(f'{over_capacity} of {len(messages)} messages over capacity')
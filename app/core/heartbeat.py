@@ -0,0 +1,45 @@
+from app.core.constants import HEARTBEAT_TIMEOUT
+from app.core.storage import get_redis
+
+
+class Heartbeat:
+    """
+    Player liveness as Redis keys expiring after TIMEOUT, refreshed by every event of the client.
+    A player without a key has a dead socket, the reaper deactivates it.
+    """
+    KEY_PREFIX = 'alive:'
+    TIMEOUT = HEARTBEAT_TIMEOUT
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def key(self, player_id):
+        return f'{self.KEY_PREFIX}{player_id}'
+
+    def touch(self, player_id):
+        """
+        Returns whether the player was alive before
+        """
+        pipe = self.connection.pipeline()
+        pipe.exists(self.key(player_id))
+        pipe.set(self.key(player_id), 1, ex=self.TIMEOUT)
+        return bool(pipe.execute()[0])
+
+    def forget(self, player_id):
+        self.connection.delete(self.key(player_id))
+
+    def dead(self, player_ids):
+        """
+        Returns the player ids without a heartbeat
+        """
+        if not player_ids:
+            return []
+        alive = self.connection.mget([self.key(player_id) for player_id in player_ids])
+        return [player_id for player_id, value in zip(player_ids, alive) if value is None]
+
+
+heartbeat = Heartbeat()
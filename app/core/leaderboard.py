@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from app.core.storage import get_redis
+
+ALL_TIME = 'all'
+WEEK = 'week'
+PERIODS = (ALL_TIME, WEEK)
+
+
+def week_start(now=None):
+    now = timezone.localtime(now or timezone.now())
+    return (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class Leaderboard:
+    """
+    Game score leaderboards in Redis: an all-time and a per week sorted set of user ids scored by total score.
+    Ranks and top-N are O(log n) reads, finished games add their scores incrementally.
+    """
+    KEY_PREFIX = 'leaderboard:'
+    BUILT_KEY = 'leaderboard:built'
+    WEEK_TTL = 5 * 7 * 24 * 60 * 60
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def key(self, period, now=None):
+        if period == WEEK:
+            return f'{self.KEY_PREFIX}{WEEK}:{week_start(now):%Y-%m-%d}'
+        return f'{self.KEY_PREFIX}{ALL_TIME}'
+
+    def is_built(self):
+        return bool(self.connection.exists(self.BUILT_KEY))
+
+    def rebuild(self, all_time, week):
+        """
+        Replaces both leaderboards with {user id: score} dicts
+        """
+        pipe = self.connection.pipeline()
+        for period, scores in ((ALL_TIME, all_time), (WEEK, week)):
+            pipe.delete(self.key(period))
+            if scores:
+                pipe.zadd(self.key(period), scores)
+        pipe.expire(self.key(WEEK), self.WEEK_TTL)
+        pipe.set(self.BUILT_KEY, 1)
+        pipe.execute()
+
+    def add_scores(self, scores):
+        transaction.on_commit(lambda: self._add_scores(scores))
+
+    def _add_scores(self, scores):
+        pipe = self.connection.pipeline()
+        for user_id, score in scores.items():
+            pipe.zincrby(self.key(ALL_TIME), score, user_id)
+            pipe.zincrby(self.key(WEEK), score, user_id)
+        pipe.expire(self.key(WEEK), self.WEEK_TTL)
+        pipe.execute()
+
+    def top(self, period, limit):
+        """
+        Returns (user id, score) pairs of the best limit users
+        """
+        return [(int(user_id), int(score))
+                for user_id, score in self.connection.zrevrange(self.key(period), 0, limit - 1, withscores=True)]
+
+    def rank(self, user_id, period):
+        """
+        Returns the 1-based rank and score of the user, (None, None) for users without games in the period
+        """
+        pipe = self.connection.pipeline()
+        pipe.zrevrank(self.key(period), user_id)
+        pipe.zscore(self.key(period), user_id)
+        rank, score = pipe.execute()
+        return (rank + 1, int(score)) if rank is not None else (None, None)
+
+
+leaderboard = Leaderboard()
@@ -0,0 +1,181 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from app.core.constants import MAX_PLAYER_COUNT
+from app.core.storage import get_redis
+
+LOBBY_GROUP = 'lobby'
+CREATED = 'created'
+CHANGED = 'changed'
+FINISHED = 'finished'
+
+
+class Lobby:
+    """
+    Index of not finished rooms in Redis: a sorted set of room ids and a hash per room with the listed fields.
+    Every change bumps a version number which is used as the ETag of the lobby listing
+    and is published as a diff to the lobby group.
+    """
+    ROOMS_KEY = 'lobby:rooms'
+    ROOM_KEY_PREFIX = 'lobby:room:'
+    VERSION_KEY = 'lobby:version'
+    BUILT_KEY = 'lobby:built'
+    INTEGER_FIELDS = ('player_count', 'current_round', 'max_round', 'status')
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def room_key(self, room_id):
+        return f'{self.ROOM_KEY_PREFIX}{room_id}'
+
+    def version(self):
+        return int(self.connection.get(self.VERSION_KEY) or 0)
+
+    def is_built(self):
+        return bool(self.connection.exists(self.BUILT_KEY))
+
+    def rebuild(self, rooms):
+        """
+        Replaces the index with rooms, dicts with id and the listed fields
+        """
+        old_ids = self.connection.zrange(self.ROOMS_KEY, 0, -1)
+        pipe = self.connection.pipeline()
+        pipe.delete(self.ROOMS_KEY, *[self.room_key(int(room_id)) for room_id in old_ids])
+        for room in rooms:
+            self._write_room(pipe, room)
+        pipe.set(self.BUILT_KEY, 1)
+        pipe.incr(self.VERSION_KEY)
+        pipe.execute()
+
+    def add_room(self, room, player_count=0):
+        data = {'id': room.id, 'name': room.name, 'player_count': player_count, 'current_round': room.current_round,
+                'max_round': room.max_round, 'status': room.status, 'private': room.private}
+        transaction.on_commit(lambda: self._add_room(data))
+
+    def change_room(self, room_id, **fields):
+        transaction.on_commit(lambda: self._change_room(room_id, fields))
+
+    def add_player(self, room_id):
+        transaction.on_commit(lambda: self._add_player(room_id))
+
+    def remove_room(self, room_id):
+        transaction.on_commit(lambda: self._remove_room(room_id))
+
+    def page(self, cursor=0, size=20, status=None, private=None, free_slots=None):
+        """
+        Returns up to size rooms with id above cursor matching the filters and the cursor of the next page
+        """
+        rooms = []
+        low = cursor
+        while len(rooms) <= size:
+            room_ids = self.connection.zrangebyscore(self.ROOMS_KEY, f'({low}', '+inf', start=0, num=size + 1)
+            if not room_ids:
+                break
+            pipe = self.connection.pipeline()
+            for room_id in room_ids:
+                pipe.hgetall(self.room_key(int(room_id)))
+            for room_id, data in zip(room_ids, pipe.execute()):
+                low = int(room_id)
+                if not data:
+                    continue
+                room = self._read_room(data)
+                if status is not None and room['status'] != status:
+                    continue
+                if private is not None and room['private'] != private:
+                    continue
+                if free_slots is not None and MAX_PLAYER_COUNT - room['player_count'] < free_slots:
+                    continue
+                rooms.append((low, room))
+                if len(rooms) > size:
+                    break
+        next_cursor = rooms[size - 1][0] if len(rooms) > size else None
+        return [room for room_id, room in rooms[:size]], next_cursor
+
+    def _write_room(self, pipe, room):
+        room_id = room['id']
+        pipe.hset(self.room_key(room_id), mapping={'name': room['name'],
+                                                   'player_count': room['player_count'],
+                                                   'current_round': room['current_round'],
+                                                   'max_round': room['max_round'],
+                                                   'status': room['status'],
+                                                   'private': int(room['private'])})
+        pipe.zadd(self.ROOMS_KEY, {room_id: room_id})
+
+    @classmethod
+    def _read_room(cls, data):
+        room = {key.decode(): value.decode() for key, value in data.items()}
+        for field in cls.INTEGER_FIELDS:
+            room[field] = int(room[field])
+        room['private'] = room['private'] == '1'
+        room['max_player_count'] = MAX_PLAYER_COUNT
+        return room
+
+    def _add_room(self, room):
+        pipe = self.connection.pipeline()
+        self._write_room(pipe, room)
+        pipe.incr(self.VERSION_KEY)
+        *_, version = pipe.execute()
+        self.publish(CREATED, version, room['name'], player_count=room['player_count'],
+                     current_round=room['current_round'], max_round=room['max_round'], status=room['status'],
+                     private=room['private'], max_player_count=MAX_PLAYER_COUNT)
+
+    def _change_room(self, room_id, fields):
+        if not self.connection.exists(self.room_key(room_id)):
+            return
+        pipe = self.connection.pipeline()
+        pipe.hset(self.room_key(room_id), mapping=fields)
+        pipe.hget(self.room_key(room_id), 'name')
+        pipe.incr(self.VERSION_KEY)
+        _, name, version = pipe.execute()
+        self.publish(CHANGED, version, name.decode(), **fields)
+
+    def _add_player(self, room_id):
+        if not self.connection.exists(self.room_key(room_id)):
+            return
+        pipe = self.connection.pipeline()
+        pipe.hincrby(self.room_key(room_id), 'player_count', 1)
+        pipe.hget(self.room_key(room_id), 'name')
+        pipe.incr(self.VERSION_KEY)
+        player_count, name, version = pipe.execute()
+        self.publish(CHANGED, version, name.decode(), player_count=player_count)
+
+    def _remove_room(self, room_id):
+        pipe = self.connection.pipeline()
+        pipe.hget(self.room_key(room_id), 'name')
+        pipe.zrem(self.ROOMS_KEY, room_id)
+        pipe.delete(self.room_key(room_id))
+        pipe.incr(self.VERSION_KEY)
+        name, *_, version = pipe.execute()
+        if name is not None:
+            self.publish(FINISHED, version, name.decode())
+
+    @staticmethod
+    def publish(change, version, name, **fields):
+        diff = {'change': change, 'name': name, **fields}
+        async_to_sync(get_channel_layer().group_send)(LOBBY_GROUP, {'type': 'lobby_diff', 'diff': diff,
+                                                                    'version': version})
+
+
+def merge_diffs(diffs, diff):
+    """
+    Coalesces diff into diffs, a dict of pending diffs by room name
+    """
+    previous = diffs.get(diff['name'])
+    if previous is None or previous['change'] == FINISHED:
+        diffs[diff['name']] = diff
+    elif diff['change'] == FINISHED:
+        if previous['change'] == CREATED:
+            del diffs[diff['name']]
+        else:
+            diffs[diff['name']] = diff
+    else:
+        previous.update({key: value for key, value in diff.items() if key != 'change'})
+    return diffs
+
+
+lobby = Lobby()
@@ -0,0 +1,149 @@
+import logging
+import time
+from smtplib import SMTPException
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils.html import strip_tags
+
+from app.core.encoding import dumps, loads
+from app.core.storage import get_redis
+
+logger = logging.getLogger(__name__)
+
+CONFIRMATION = 'confirmation'
+RESET_PASSWORD = 'reset_password'
+EMAILS = {
+    CONFIRMATION: ('Friend Bucket Email Confirmation', 'confirmation_email.html', 'confirm_email'),
+    RESET_PASSWORD: ('Friend Bucket Password Reset', 'reset_password_email.html', 'reset_password'),
+}
+
+_templates = {}
+
+
+def render(template_name, context):
+    """
+    Renders a template compiled once per process
+    """
+    if template_name not in _templates:
+        _templates[template_name] = get_template(template_name)
+    return _templates[template_name].render(context)
+
+
+def build_message(kind, user, connection=None):
+    subject, template_name, path = EMAILS[kind]
+    link = f'http://{settings.FRONTEND_URL}/{path}/?token={user.custom_token}'
+    html_message = render(template_name, {'username': user.username, 'link': link})
+    message = EmailMultiAlternatives(subject, strip_tags(html_message), settings.EMAIL_HOST_USER, (user.email,),
+                                     connection=connection)
+    message.attach_alternative(html_message, 'text/html')
+    return message
+
+
+class MailQueue:
+    """
+    Outbound emails in Redis, enqueued after the transaction commits and sent by the send_emails service.
+    Failed emails wait in a sorted set scored by their next attempt time, the delay doubles every attempt.
+    """
+    QUEUE_KEY = 'mail:queue'
+    RETRY_KEY = 'mail:retry'
+    MAX_ATTEMPTS = 5
+    BACKOFF = 30
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def enqueue(self, kind, user_id):
+        transaction.on_commit(lambda: self._enqueue(kind, user_id))
+
+    def _enqueue(self, kind, user_id):
+        self.connection.rpush(self.QUEUE_KEY, dumps({'kind': kind, 'user_id': user_id, 'attempt': 0}))
+
+    def pop(self, batch, now=None):
+        """
+        Takes the due retries and up to batch queued emails
+        """
+        now = now or time.time()
+        pipe = self.connection.pipeline()
+        pipe.zrangebyscore(self.RETRY_KEY, 0, now)
+        pipe.zremrangebyscore(self.RETRY_KEY, 0, now)
+        pipe.lrange(self.QUEUE_KEY, 0, batch - 1)
+        pipe.ltrim(self.QUEUE_KEY, batch, -1)
+        due, _, queued, _ = pipe.execute()
+        return [loads(job) for job in due + queued]
+
+    def retry(self, job, now=None):
+        """
+        Schedules the next attempt, returns False when the email is dropped after MAX_ATTEMPTS
+        """
+        attempt = job['attempt'] + 1
+        if attempt >= self.MAX_ATTEMPTS:
+            return False
+        due = (now or time.time()) + self.BACKOFF * 2 ** (attempt - 1)
+        self.connection.zadd(self.RETRY_KEY, {dumps(dict(job, attempt=attempt)): due})
+        return True
+
+
+mail_queue = MailQueue()
+
+
+class MailSender:
+    """
+    Sends queued emails over one SMTP connection kept open while there is mail, closed when the queue is idle
+    """
+    def __init__(self, queue=mail_queue):
+        self.queue = queue
+        self.connection = None
+        self.sent = 0
+
+    def send_batch(self, batch):
+        """
+        Sends up to batch queued emails, returns the number of emails taken from the queue
+        """
+        jobs = self.queue.pop(batch)
+        if not jobs:
+            self.close()
+            return 0
+        try:
+            users = get_user_model().objects.in_bulk({job['user_id'] for job in jobs})
+        except Exception:
+            for job in jobs:
+                self.fail(job)
+            return len(jobs)
+        if self.connection is None:
+            self.connection = get_connection()
+        for job in jobs:
+            user = users.get(job['user_id'])
+            if user is None:
+                continue
+            try:
+                message = build_message(job['kind'], user, self.connection)
+                self.connection.open()
+                self.connection.send_messages((message,))
+                self.sent += 1
+            except (SMTPException, OSError):
+                self.fail(job)
+                self.connection.close()
+            except Exception:
+                self.fail(job)
+        return len(jobs)
+
+    def fail(self, job):
+        """
+        Logs the error being handled and schedules a retry, popped jobs are never lost silently
+        """
+        logger.exception('Email %s to user %s failed, attempt %s', job['kind'], job['user_id'], job['attempt'] + 1)
+        if not self.queue.retry(job):
+            logger.error('Email %s to user %s dropped', job['kind'], job['user_id'])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
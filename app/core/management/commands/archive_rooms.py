@@ -0,0 +1,56 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.core.event_log import event_log
+from app.core.models import ArchivedRoom
+from app.core.state import RoomState
+from app.core.storage import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Moves finished rooms to the archive tables in short batches, --loop keeps archiving as a service'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=100, help='rooms per transaction')
+        parser.add_argument('--older-than', type=float, default=60, help='minutes since the room finished')
+        parser.add_argument('--loop', action='store_true', help='archive again every interval')
+        parser.add_argument('--interval', type=float, default=300, help='loop interval in seconds')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        while True:
+            try:
+                archived = self.archive(options['batch'], timezone.now() - timedelta(minutes=options['older_than']))
+                self.stdout.write(self.style.SUCCESS(f'{archived} rooms archived'))
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Archiving rooms failed')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def archive(self, batch, finished_before):
+        """
+        Walks the archivable rooms by id, every batch is its own transaction so locks are held briefly
+        """
+        last_id = 0
+        total = 0
+        while True:
+            room_ids = list(ArchivedRoom.objects.archivable(finished_before).filter(id__gt=last_id)[:batch])
+            if not room_ids:
+                return total
+            archived = ArchivedRoom.objects.archive(room_ids)
+            for room_id in archived:
+                get_redis().delete(RoomState.key(room_id))
+                event_log.clear(room_id)
+            total += len(archived)
+            last_id = room_ids[-1]
+            if self.verbosity > 1:
+                self.stdout.write(f'{total} rooms archived, last id {last_id}')
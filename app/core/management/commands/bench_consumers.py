@@ -0,0 +1,111 @@
+import asyncio
+import time
+from uuid import uuid4
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import re_path
+
+from app.core.constants import MAX_PLAYER_COUNT
+from app.core.consumers import RoomConsumer, SyncRoomConsumer
+from app.core.event_log import event_log
+from app.core.middleware import JWTAuthMiddleware
+from app.core.models import Room, Player, Color
+from app.core.state import RoomState
+from app.core.storage import get_redis
+
+BENCH_PREFIX = 'bench'
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Load benchmark of sync and async room consumers by sockets per process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, nargs='+', default=[50, 100, 200, 400])
+        parser.add_argument('--room-size', type=int, default=MAX_PLAYER_COUNT)
+        parser.add_argument('--budget', type=float, default=100, help='p99 join latency budget in ms')
+        parser.add_argument('--redis', action='store_true', help='use configured channel layer instead of in-memory')
+
+    def handle(self, *args, **options):
+        sockets = sorted(options['sockets'])
+        self.room_ids = []
+        self.user_ids = []
+        try:
+            players = self.create_players(sockets[-1], options['room_size'])
+            for consumer in (SyncRoomConsumer, RoomConsumer):
+                application = URLRouter([re_path(r'game/(?P<room_name>\w+)/$', JWTAuthMiddleware(consumer))])
+                capacity = 0
+                for number in sockets:
+                    self.reset_rooms()
+                    if options['redis']:
+                        result = asyncio.run(self.run_sockets(application, players[:number]))
+                    else:
+                        with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+                            result = asyncio.run(self.run_sockets(application, players[:number]))
+                    elapsed, latencies = result
+                    p99 = percentile(latencies, 99)
+                    if p99 <= options['budget']:
+                        capacity = number
+                    self.stdout.write(f'{consumer.__name__:<17} sockets={number:<5} joins/s={number / elapsed:<9.1f} '
+                                      f'p50={percentile(latencies, 50):.1f}ms p99={p99:.1f}ms')
+                self.stdout.write(self.style.SUCCESS(f'{consumer.__name__}: {capacity} sockets per process '
+                                                     f'within {options["budget"]}ms p99'))
+        finally:
+            self.delete_players()
+
+    def create_players(self, number, room_size):
+        """
+        Creates the rooms and users of the run, names are unique per run and the ids are kept for the cleanup
+        """
+        prefix = f'{BENCH_PREFIX}{uuid4().hex[:8]}'
+        colors = list(Color.objects.all()) or [Color.objects.create(name='000000')]
+        players = []
+        room = None
+        for i in range(number):
+            if i % room_size == 0:
+                room = Room.objects.create(name=f'{prefix}{i // room_size}')
+                self.room_ids.append(room.id)
+            user = get_user_model().objects.create(username=f'{prefix}_user_{i}',
+                                                   email=f'{prefix}_user_{i}@example.com')
+            self.user_ids.append(user.id)
+            Player.objects.create(user=user, username=user.username, room=room, color=colors[i % len(colors)])
+            players.append((room.name, user.tokens_pair['access']))
+        return players
+
+    def reset_rooms(self):
+        get_redis().delete(*[RoomState.key(room_id) for room_id in self.room_ids])
+        Room.objects.filter(id__in=self.room_ids).update(status=Room.PENDING)
+        Player.objects.filter(room_id__in=self.room_ids).update(active=False)
+
+    def delete_players(self):
+        for room_id in self.room_ids:
+            get_redis().delete(RoomState.key(room_id))
+            event_log.clear(room_id)
+        Room.objects.filter(id__in=self.room_ids).delete()
+        get_user_model().objects.filter(id__in=self.user_ids).delete()
+
+    async def run_sockets(self, application, players):
+        communicators = [WebsocketCommunicator(application, f'/game/{room_name}/?token={token}')
+                         for room_name, token in players]
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(self.join(communicator) for communicator in communicators))
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        return elapsed, latencies
+
+    @staticmethod
+    async def join(communicator):
+        start = time.perf_counter()
+        await communicator.connect(timeout=30)
+        while (await communicator.receive_json_from(timeout=30)).get('eventType') != 'define':
+            pass
+        return (time.perf_counter() - start) * 1000
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from app.core.constants import MAX_PLAYER_COUNT
+from app.core.encoding import dumps
+from app.core.fanout import send_many
+from app.core.management.commands.bench_consumers import IN_MEMORY_CHANNEL_LAYERS
+from app.core.utils import start_event
+
+BENCH_GROUP = 'bench_fanout'
+
+
+async def send_each(channel_layer, channels, message):
+    for channel_name in channels:
+        await channel_layer.send(channel_name, message)
+
+
+async def send_pipelined(channel_layer, channels, message):
+    await send_many(channel_layer, [(channel_name, message) for channel_name in channels])
+
+
+async def send_group(channel_layer, channels, message):
+    await channel_layer.group_send(BENCH_GROUP, message)
+
+
+STRATEGIES = (('send', send_each), ('send_many', send_pipelined), ('group_send', send_group))
+
+
+class Command(BaseCommand):
+    help = 'Sends per second of the room fan-out strategies: one send per player, pipelined sends and a group send'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=MAX_PLAYER_COUNT)
+        parser.add_argument('--events', type=int, default=500, help='fan-outs per strategy')
+        parser.add_argument('--redis', action='store_true', help='use configured channel layer instead of in-memory')
+
+    def handle(self, *args, **options):
+        if options['redis']:
+            results = asyncio.run(self.run_strategies(options['players'], options['events']))
+        else:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+                results = asyncio.run(self.run_strategies(options['players'], options['events']))
+        sends = options['players'] * options['events']
+        for name, send_time, elapsed in results:
+            self.stdout.write(f'{name:<10} players={options["players"]:<3} sends/s={sends / send_time:<9.0f} '
+                              f'delivered/s={sends / elapsed:<9.0f} '
+                              f'fan-out={send_time / options["events"] * 1000:.2f}ms')
+
+    async def run_strategies(self, players, events):
+        channel_layer = get_channel_layer()
+        channels = [await channel_layer.new_channel() for _ in range(players)]
+        for channel_name in channels:
+            await channel_layer.group_add(BENCH_GROUP, channel_name)
+        message = {'type': 'send_encoded', 'text': dumps(start_event([{'questionId': 1, 'text': 'Question'}] * 2))}
+        try:
+            return [(name, *await self.run_strategy(channel_layer, channels, message, strategy, events))
+                    for name, strategy in STRATEGIES]
+        finally:
+            for channel_name in channels:
+                await channel_layer.group_discard(BENCH_GROUP, channel_name)
+
+    @staticmethod
+    async def run_strategy(channel_layer, channels, message, strategy, events):
+        """
+        Returns the time spent sending and the total time, every fan-out waits until all players got it
+        """
+        send_time = 0
+        start = time.perf_counter()
+        for _ in range(events):
+            send_start = time.perf_counter()
+            await strategy(channel_layer, channels, message)
+            send_time += time.perf_counter() - send_start
+            await asyncio.gather(*[channel_layer.receive(channel_name) for channel_name in channels])
+        return send_time, time.perf_counter() - start
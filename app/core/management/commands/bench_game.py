@@ -0,0 +1,171 @@
+import asyncio
+import time
+from io import StringIO
+from random import uniform
+from uuid import uuid4
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.test import override_settings
+from django.urls import re_path
+
+from app.core.consumers import RoomConsumer
+from app.core.event_log import event_log
+from app.core.management.commands.bench_consumers import IN_MEMORY_CHANNEL_LAYERS, percentile
+from app.core.metrics import OBSERVERS
+from app.core.middleware import JWTAuthMiddleware
+from app.core.models import Room, Player, Color, Task
+from app.core.state import RoomState
+from app.core.pool import task_pool
+from app.core.storage import get_redis
+from app.core.timers import room_timers
+
+BENCH_PREFIX = 'benchgame'
+ROUND_EVENTS = ('start', 'answer', 'voteList')
+
+
+class Command(BaseCommand):
+    help = 'Load test of full game rounds over websockets: N rooms of M players'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--players', type=int, default=5)
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--think', type=float, default=0.05, help='max random delay before each event in seconds')
+        parser.add_argument('--timeout', type=float, default=10, help='wait for a server event in seconds')
+        parser.add_argument('--redis', action='store_true', help='use configured channel layer instead of in-memory')
+
+    def handle(self, *args, **options):
+        self.prefix = f'{BENCH_PREFIX}{uuid4().hex[:8]}'
+        self.room_ids = []
+        self.user_ids = []
+        self.task_ids = []
+        samples = []
+        OBSERVERS.append(samples.append)
+        try:
+            # every room draws its own distinct tasks, one per player and round
+            self.create_tasks(options['players'] * options['rounds'] - Task.objects.count())
+            rooms = self.create_rooms(options['rooms'], options['players'], options['rounds'])
+            if options['redis']:
+                elapsed = asyncio.run(self.run_rooms(rooms, options))
+            else:
+                with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+                    elapsed = asyncio.run(self.run_rooms(rooms, options))
+        finally:
+            OBSERVERS.remove(samples.append)
+            self.delete_rooms()
+        self.report(samples, elapsed, options['rooms'] * options['rounds'])
+
+    def create_tasks(self, missing):
+        """
+        Tops the tasks up with generate_test_tasks, the ids above the previous last one are kept for the cleanup
+        """
+        if missing <= 0:
+            return
+        last_id = Task.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        call_command('generate_test_tasks', missing, stdout=StringIO())
+        self.task_ids = list(Task.objects.filter(id__gt=last_id).values_list('id', flat=True))
+
+    def create_rooms(self, number, room_size, rounds):
+        """
+        Creates the rooms and users of the run, names are unique per run and the ids are kept for the cleanup
+        """
+        colors = list(Color.objects.all()) or [Color.objects.create(name='000000')]
+        rooms = []
+        for i in range(number):
+            room = Room.objects.create(name=f'{self.prefix}{i}', max_round=rounds)
+            self.room_ids.append(room.id)
+            tokens = []
+            for j in range(room_size):
+                user = get_user_model().objects.create(username=f'{self.prefix}_user_{i}_{j}',
+                                                       email=f'{self.prefix}_user_{i}_{j}@example.com')
+                self.user_ids.append(user.id)
+                Player.objects.create(user=user, username=user.username, room=room, host=j == 0,
+                                      color=colors[j % len(colors)])
+                tokens.append(user.tokens_pair['access'])
+            rooms.append((room.name, tokens))
+        return rooms
+
+    def delete_rooms(self):
+        for room_id in self.room_ids:
+            get_redis().delete(RoomState.key(room_id), task_pool.used_key(room_id))
+            event_log.clear(room_id)
+            room_timers.cancel(room_id)
+        Room.objects.filter(id__in=self.room_ids).delete()
+        get_user_model().objects.filter(id__in=self.user_ids).delete()
+        if self.task_ids:
+            Task.objects.filter(id__in=self.task_ids).delete()
+            task_pool.invalidate()
+
+    async def run_rooms(self, rooms, options):
+        application = URLRouter([re_path(r'game/(?P<room_name>\w+)/$', JWTAuthMiddleware(RoomConsumer))])
+        start = time.perf_counter()
+        await asyncio.gather(*[self.play(application, name, tokens, options) for name, tokens in rooms])
+        return time.perf_counter() - start
+
+    async def play(self, application, name, tokens, options):
+        sockets = [WebsocketCommunicator(application, f'/game/{name}/?token={token}') for token in tokens]
+        player_ids = []
+        for socket in sockets:
+            await socket.connect()
+            player_ids.append((await self.receive(socket, options, 'define'))['userId'])
+        for _ in range(options['rounds']):
+            await self.think(options)
+            await sockets[0].send_json_to(self.event('start'))
+            questions = await asyncio.gather(*[self.receive(socket, options, 'questionList') for socket in sockets])
+            await asyncio.gather(*[self.answer(socket, data['questions'], options)
+                                   for socket, data in zip(sockets, questions)])
+            tasks = await asyncio.gather(*[self.receive(socket, options, 'voteList') for socket in sockets])
+            await asyncio.gather(*[self.vote(socket, player_id, data['tasks'], options)
+                                   for socket, player_id, data in zip(sockets, player_ids, tasks)])
+            await asyncio.gather(*[self.receive(socket, options, 'score', 'winner') for socket in sockets])
+        for socket in sockets:
+            await socket.disconnect()
+
+    async def answer(self, socket, questions, options):
+        await self.think(options)
+        await socket.send_json_to(self.event('answer', answer=[{'questionId': question['questionId'],
+                                                                'answer': 'answer'} for question in questions]))
+
+    async def vote(self, socket, player_id, tasks, options):
+        await self.think(options)
+        votes = [{'questionId': task['questionId'], 'voteId': answer['userID']}
+                 for task in tasks for answer in task['answers'] if answer['userID'] != player_id][:1]
+        await socket.send_json_to(self.event('voteList', votes=votes))
+
+    @staticmethod
+    async def think(options):
+        if options['think']:
+            await asyncio.sleep(uniform(0, options['think']))
+
+    @staticmethod
+    async def receive(socket, options, *event_types):
+        """
+        Skips server events until one of event_types arrives
+        """
+        while True:
+            data = await socket.receive_json_from(timeout=options['timeout'])
+            if data['eventType'] in event_types:
+                return data
+
+    @staticmethod
+    def event(event_type, **kwargs):
+        return {'eventType': event_type, 'timestamp': time.time(), **kwargs}
+
+    def report(self, samples, elapsed, rounds):
+        by_type = {}
+        for stats in samples:
+            by_type.setdefault(stats.event_type, []).append(stats)
+        for event_type, stats in sorted(by_type.items()):
+            latencies = [item.latency * 1000 for item in stats]
+            self.stdout.write(f'{event_type:<10} events={len(stats):<6} p50={percentile(latencies, 50):.1f}ms '
+                              f'p99={percentile(latencies, 99):.1f}ms '
+                              f'queries/event={sum(item.queries for item in stats) / len(stats):.1f}')
+        round_queries = sum(stats.queries for stats in samples if stats.event_type in ROUND_EVENTS)
+        self.stdout.write(self.style.SUCCESS(f'{len(samples)} events in {elapsed:.2f}s, '
+                                             f'{len(samples) / elapsed:.1f} events/s, '
+                                             f'{round_queries / rounds:.1f} queries per round'))
@@ -0,0 +1,109 @@
+import time
+from random import shuffle
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.core.constants import MAX_PLAYER_COUNT, SCOPE_ORDER
+from app.core.models import Room, Player, Color, Task, PlayerTask
+from app.core.pool import task_pool
+from app.core.storage import get_redis
+
+BENCH_PREFIX = 'bench'
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = 'Benchmark of round start latency against Task table size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--players', type=int, default=MAX_PLAYER_COUNT)
+        parser.add_argument('--keep', action='store_true', help="don't delete generated tasks")
+
+    def handle(self, *args, **options):
+        self.prefix = f'{BENCH_PREFIX}{uuid4().hex[:8]}'
+        self.user_ids = []
+        self.task_ids = []
+        room = None
+        try:
+            room, players = self.create_room(options['players'])
+            for size in sorted(options['sizes']):
+                self.fill_tasks(size)
+                legacy = self.measure(self.legacy_round, room, players, options['repeat'])
+                # the first round after fill_tasks builds the pool, it is reported apart from the cached rounds
+                cold = self.measure(self.round, room, players, 1)
+                current = self.measure(self.round, room, players, options['repeat'])
+                get_redis().delete(task_pool.used_key(room.id))
+                self.stdout.write(f'tasks={size:<8} order_by_random={legacy:.2f}ms task_pool={current:.2f}ms '
+                                  f'task_pool_cold={cold:.2f}ms')
+        finally:
+            if room is not None:
+                get_redis().delete(task_pool.used_key(room.id))
+                room.delete()
+            get_user_model().objects.filter(id__in=self.user_ids).delete()
+            if not options['keep']:
+                for offset in range(0, len(self.task_ids), BATCH_SIZE):
+                    Task.objects.filter(id__in=self.task_ids[offset:offset + BATCH_SIZE]).delete()
+                task_pool.invalidate()
+
+    def create_room(self, number):
+        """
+        Creates the room and users of the run, names are unique per run and the ids are kept for the cleanup
+        """
+        room = Room.objects.create(name=self.prefix + 'round')
+        colors = list(Color.objects.all()) or [Color.objects.create(name='000000')]
+        players = []
+        for i in range(number):
+            user = get_user_model().objects.create(username=f'{self.prefix}_user_{i}',
+                                                   email=f'{self.prefix}_user_{i}@example.com')
+            self.user_ids.append(user.id)
+            players.append(Player.objects.create(user=user, username=user.username, room=room,
+                                                 color=colors[i % len(colors)]).id)
+        return room, players
+
+    def fill_tasks(self, size):
+        created = Task.objects.count()
+        while created < size:
+            batch = min(BATCH_SIZE, size - created)
+            titles = [f'{self.prefix} task {created + i}' for i in range(batch)]
+            Task.objects.bulk_create(Task(title=title) for title in titles)
+            self.task_ids.extend(Task.objects.filter(title__in=titles).values_list('id', flat=True))
+            created += batch
+        task_pool.invalidate()
+
+    @staticmethod
+    def measure(round_start, room, players, repeat):
+        elapsed = 0
+        for _ in range(repeat):
+            with transaction.atomic():
+                start = time.perf_counter()
+                round_start(room, players)
+                elapsed += time.perf_counter() - start
+                transaction.set_rollback(True)
+        return elapsed / repeat * 1000
+
+    @staticmethod
+    def assignments(players, game_tasks):
+        repetitive_tasks = game_tasks.copy()
+        repetitive_tasks.append(repetitive_tasks.pop(0))
+        players = players.copy()
+        shuffle(players)
+        return {player_id: [game_tasks[i], repetitive_tasks[i]] for i, player_id in enumerate(players)}
+
+    def legacy_round(self, room, players):
+        all_tasks = Task.objects.exclude(playertasks__player__room=room)
+        all_tasks.count()
+        game_tasks = list(all_tasks.order_by('?').values_list('id', 'title')[:len(players)])
+        for player_id, player_tasks in self.assignments(players, game_tasks).items():
+            for task_id, title in player_tasks:
+                PlayerTask.objects.create(task_id=task_id, player_id=player_id, round=1, scope_cost=SCOPE_ORDER)
+
+    def round(self, room, players):
+        sampled = task_pool.sample(room.id, [], len(players))
+        game_tasks = [[task_id, title] for task_id, title, position in sampled]
+        PlayerTask.objects.create_round(self.assignments(players, game_tasks), 1, SCOPE_ORDER)
+        task_pool.mark_used(room.id, [], [position for task_id, title, position in sampled])
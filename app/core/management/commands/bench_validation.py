@@ -0,0 +1,57 @@
+import time
+
+import jsonschema
+from django.core.management.base import BaseCommand
+
+from app.core.schemas import EVENTS_SCHEMAS
+from app.core.utils import validate_event
+
+FRAMES = {
+    'greeting': {'eventType': 'greeting', 'timestamp': 1.0, 'token': 'token'},
+    'start': {'eventType': 'start', 'timestamp': 1.0},
+    'answer': {'eventType': 'answer', 'timestamp': 1.0,
+               'answer': [{'questionId': 1, 'answer': 'answer'}, {'questionId': 2, 'answer': 'answer'}]},
+    'voteList': {'eventType': 'voteList', 'timestamp': 1.0,
+                 'votes': [{'questionId': i, 'voteId': i} for i in range(10)]},
+    'invalid': {'eventType': 'answer', 'timestamp': 1.0, 'answer': [{'questionId': 'one'}]},
+}
+
+
+def legacy_validate_event(event):
+    """
+    Validation before precompiled validators: every schema, validator rebuilt on each call
+    """
+    results = []
+    for schema in EVENTS_SCHEMAS:
+        try:
+            jsonschema.validate(event, schema)
+        except jsonschema.exceptions.ValidationError:
+            results.append(False)
+        else:
+            results.append(True)
+    return any(results)
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark of incoming event validation in frames per second'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=1)
+
+    def handle(self, *args, **options):
+        for name, frame in FRAMES.items():
+            legacy = self.measure(legacy_validate_event, frame, options['seconds'])
+            current = self.measure(validate_event, frame, options['seconds'])
+            self.stdout.write(f'{name:<9} legacy={legacy:>10.0f} frames/s  compiled={current:>10.0f} frames/s  '
+                              f'x{current / legacy:.1f}')
+
+    @staticmethod
+    def measure(validate, frame, seconds):
+        frames = 0
+        start = time.perf_counter()
+        deadline = start + seconds
+        while time.perf_counter() < deadline:
+            for _ in range(100):
+                validate(frame)
+            frames += 100
+        return frames / (time.perf_counter() - start)
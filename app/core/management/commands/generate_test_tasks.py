@@ -1,5 +1,8 @@
 from django.core.management.base import BaseCommand
 from app.core.models import Task
+from app.core.pool import task_pool
+
+BATCH_SIZE = 5000
 
 
 class Command(BaseCommand):
@@ -10,6 +13,10 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         task_count = Task.objects.count() + 1
-        for i in range(options.get('number', 1)):
-            Task.objects.create(title=f'Test task №{task_count + i}')
-            self.stdout.write(self.style.SUCCESS(f'Successfully creating test task №{task_count + i}'))
+        number = options.get('number', 1)
+        for offset in range(0, number, BATCH_SIZE):
+            Task.objects.bulk_create(Task(title=f'Test task №{task_count + i}')
+                                     for i in range(offset, min(offset + BATCH_SIZE, number)))
+        task_pool.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Successfully creating test tasks '
+                                             f'№{task_count}-№{task_count + number - 1}'))
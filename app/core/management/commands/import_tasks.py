@@ -0,0 +1,77 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.core.models import Pack, Task
+from app.core.pool import task_pool
+
+TITLE_MAX_LENGTH = Task._meta.get_field('title').max_length
+
+
+class Command(BaseCommand):
+    help = 'Streaming import of task packs from JSONL or CSV files with "title" and optional "pack" fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--pack', help='pack title for rows without a pack')
+        parser.add_argument('--format', choices=('jsonl', 'csv'), help='default is taken from the file extension')
+        parser.add_argument('--chunk', type=int, default=5000, help='rows per bulk insert')
+
+    def handle(self, *args, **options):
+        self.packs = {}
+        for path in options['paths']:
+            file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if file_format not in ('jsonl', 'csv'):
+                raise CommandError(f'Unknown format of {path}, use --format')
+            with open(path, newline='', encoding='utf-8') as file:
+                rows = self.read_jsonl(file) if file_format == 'jsonl' else csv.DictReader(file)
+                self.import_rows(path, rows, options['pack'], options['chunk'])
+        task_pool.invalidate(self.packs.values())
+
+    @staticmethod
+    def read_jsonl(file):
+        """
+        Yields the rows of the file, None for lines that aren't valid JSON
+        """
+        for line in file:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+    def import_rows(self, path, rows, default_pack, chunk_size):
+        rows = iter(rows)
+        total = skipped = 0
+        existing = Task.objects.count()
+        start = time.perf_counter()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            tasks = []
+            for row in chunk:
+                title = row.get('title') if isinstance(row, dict) else None
+                title = title.strip() if isinstance(title, str) else ''
+                if not title or len(title) > TITLE_MAX_LENGTH:
+                    skipped += 1
+                    continue
+                tasks.append(Task(title=title, pack_id=self.pack_id(row.get('pack') or default_pack)))
+            Task.objects.bulk_create(tasks, ignore_conflicts=True)
+            total += len(chunk)
+            self.stdout.write(f'{path}: {total} rows, {total / (time.perf_counter() - start):.0f} rows/s')
+        created = Task.objects.count() - existing
+        self.stdout.write(self.style.SUCCESS(f'{path}: {total - skipped} rows submitted in '
+                                             f'{time.perf_counter() - start:.1f}s, {created} tasks created '
+                                             f'(existing titles kept), {skipped} invalid rows skipped'))
+
+    def pack_id(self, title):
+        if not title:
+            return None
+        if title not in self.packs:
+            self.packs[title] = Pack.objects.get_or_create(title=title)[0].id
+        return self.packs[title]
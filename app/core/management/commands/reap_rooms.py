@@ -0,0 +1,75 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.core.constants import HEARTBEAT_TIMEOUT
+from app.core.heartbeat import heartbeat
+from app.core.models import Room, Player
+from app.core.state import RoomState, change_room_state
+from app.core.storage import get_redis
+from app.core.timers import room_timers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deactivates players without a heartbeat and finishes rooms nobody is connected to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500, help='players or rooms per update')
+        parser.add_argument('--grace', type=float, default=HEARTBEAT_TIMEOUT,
+                            help='seconds a new room may stay without players')
+        parser.add_argument('--loop', action='store_true', help='reap again every interval')
+        parser.add_argument('--interval', type=float, default=HEARTBEAT_TIMEOUT, help='loop interval in seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                players = self.reap_players(options['batch'])
+                rooms = self.reap_rooms(options['batch'], timezone.now() - timedelta(seconds=options['grace']))
+                self.stdout.write(self.style.SUCCESS(f'{rooms} rooms and {players} players reclaimed'))
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Reaping rooms failed')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    @staticmethod
+    def reap_players(batch):
+        """
+        Walks the active players by id and deactivates the ones without a heartbeat in one update per batch
+        """
+        last_id = 0
+        total = 0
+        while True:
+            players = dict(Player.objects.filter(active=True, id__gt=last_id).order_by('id')
+                                         .values_list('id', 'room_id')[:batch])
+            if not players:
+                return total
+            dead = heartbeat.dead(list(players))
+            total += Player.objects.deactivate(dead)
+            for player_id in dead:
+                change_room_state(players[player_id], lambda state: state.leave(player_id))
+            last_id = max(players)
+
+    @staticmethod
+    def reap_rooms(batch, created_before):
+        """
+        Finishes the rooms without active players, one update per batch.
+        Their cached state is dropped, so it is loaded finished if a late player comes back.
+        """
+        total = 0
+        while True:
+            room_ids = list(Room.objects.abandoned(created_before)[:batch])
+            if not room_ids:
+                return total
+            finished = Room.objects.finish_rooms(room_ids)
+            for room_id in finished:
+                room_timers.cancel(room_id)
+                get_redis().delete(RoomState.key(room_id))
+            total += len(finished)
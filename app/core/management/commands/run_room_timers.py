@@ -0,0 +1,45 @@
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from app.core.fanout import send_many
+from app.core.protocol import Outbox, RoomProtocol
+from app.core.timers import room_timers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Room phase timer service, fires expired answering and voting timers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0.2, help='idle poll interval in seconds')
+        parser.add_argument('--batch', type=int, default=100)
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        while True:
+            expired = room_timers.pop_due(options['batch'])
+            for room_id, event in expired:
+                try:
+                    self.fire(channel_layer, room_id, event)
+                except Exception:
+                    logger.exception('Timer %s of room %s failed', event, room_id)
+            if len(expired) < options['batch']:
+                time.sleep(options['interval'])
+
+    @staticmethod
+    def fire(channel_layer, room_id, event):
+        protocol = RoomProtocol.for_room(room_id)
+        outbox = Outbox()
+        protocol.expire(outbox, event)
+        for kind, payload in outbox.deliveries():
+            if kind == Outbox.GROUP:
+                async_to_sync(channel_layer.group_send)(protocol.room_group_name, {'type': 'send_encoded',
+                                                                                   'text': payload})
+            elif kind == Outbox.DIRECT:
+                async_to_sync(send_many)(channel_layer, [(channel_name, {'type': 'send_encoded', 'text': text})
+                                                         for channel_name, text in payload])
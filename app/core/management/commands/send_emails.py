@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.core.mail import MailSender
+
+
+class Command(BaseCommand):
+    help = 'Outbound email service, sends queued emails in batches over one SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=50)
+        parser.add_argument('--interval', type=float, default=1, help='idle poll interval in seconds')
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        sender = MailSender()
+        while True:
+            taken = sender.send_batch(options['batch'])
+            if not taken and options['once']:
+                self.stdout.write(self.style.SUCCESS(f'{sender.sent} emails sent'))
+                return
+            if taken < options['batch'] and not options['once']:
+                time.sleep(options['interval'])
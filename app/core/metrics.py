@@ -0,0 +1,101 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from django.db import connection
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+class Histogram:
+    """
+    Cumulative histogram labelled by websocket event type, rendered in the Prometheus text format
+    """
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * len(buckets))
+        self.sums = defaultdict(float)
+        self.totals = defaultdict(int)
+        self.lock = Lock()
+
+    def observe(self, event_type, value):
+        with self.lock:
+            counts = self.counts[event_type]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.sums[event_type] += value
+            self.totals[event_type] += 1
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for event_type, counts in sorted(self.counts.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{event="{event_type}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{event="{event_type}",le="+Inf"}} {self.totals[event_type]}')
+                lines.append(f'{self.name}_sum{{event="{event_type}"}} {self.sums[event_type]}')
+                lines.append(f'{self.name}_count{{event="{event_type}"}} {self.totals[event_type]}')
+        return lines
+
+
+EVENT_SECONDS = Histogram('ws_event_seconds', 'Websocket event handling latency', LATENCY_BUCKETS)
+EVENT_QUERIES = Histogram('ws_event_queries', 'SQL queries per websocket event', QUERY_BUCKETS)
+EVENT_DB_SECONDS = Histogram('ws_event_db_seconds', 'SQL time per websocket event', LATENCY_BUCKETS)
+EVENT_LAYER_SECONDS = Histogram('ws_event_layer_seconds', 'Channel layer time per websocket event', LATENCY_BUCKETS)
+HISTOGRAMS = (EVENT_SECONDS, EVENT_QUERIES, EVENT_DB_SECONDS, EVENT_LAYER_SECONDS)
+OBSERVERS = []
+
+
+class EventStats:
+    """
+    Costs of one websocket event: queries and DB time of counted calls, channel layer time and total latency
+    """
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self.queries = 0
+        self.db_time = 0
+        self.layer_time = 0
+        self.start = perf_counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += perf_counter() - start
+
+    def counted(self, func):
+        """
+        Wraps func to count its queries, the wrapper must run in the thread that does the queries
+        """
+        def wrapper(*args, **kwargs):
+            with connection.execute_wrapper(self):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def layer(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.layer_time += perf_counter() - start
+
+    def observe(self):
+        self.latency = perf_counter() - self.start
+        EVENT_SECONDS.observe(self.event_type, self.latency)
+        EVENT_QUERIES.observe(self.event_type, self.queries)
+        EVENT_DB_SECONDS.observe(self.event_type, self.db_time)
+        EVENT_LAYER_SECONDS.observe(self.event_type, self.layer_time)
+        for observer in OBSERVERS:
+            observer(self)
+
+
+def exposition():
+    return '\n'.join(line for histogram in HISTOGRAMS for line in histogram.exposition()) + '\n'
@@ -0,0 +1,61 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from rest_framework.exceptions import AuthenticationFailed
+
+from app.core.models import Player, Room
+from app.core.protocol import jwt_authentication
+
+TOKEN_SUBPROTOCOL = 'Bearer'
+
+
+def handshake_token(scope):
+    """
+    Returns the JWT of the handshake and the subprotocol to accept.
+    The token is taken from ?token= or from the subprotocols "Bearer, <token>".
+    """
+    subprotocols = scope.get('subprotocols') or []
+    if len(subprotocols) == 2 and subprotocols[0] == TOKEN_SUBPROTOCOL:
+        return subprotocols[1], TOKEN_SUBPROTOCOL
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    return (tokens[0], None) if tokens else (None, None)
+
+
+def handshake_version(scope):
+    """
+    Returns the last event version seen by a reconnecting client, ?version= of the handshake
+    """
+    versions = parse_qs(scope.get('query_string', b'').decode()).get('version')
+    return int(versions[0]) if versions and versions[0].isdigit() else None
+
+
+@database_sync_to_async
+def get_player(token, room_name):
+    try:
+        user = jwt_authentication.get_user(jwt_authentication.get_validated_token(token))
+    except AuthenticationFailed:
+        return None, None
+    if room_name is None:
+        return user, None
+    player = Player.objects.exclude(room__status=Room.FINISHED).filter(user=user, room__name=room_name).first()
+    return user, player
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates game sockets during the handshake and puts user, player and subprotocol into the scope.
+    Player is None for unauthenticated sockets and users without a player in the room.
+    Wraps a routed consumer, the room comes from the url route, routes without a room only get the user.
+    """
+    def populate_scope(self, scope):
+        scope['user'] = None
+        scope['player'] = None
+        scope['subprotocol'] = None
+
+    async def resolve_scope(self, scope):
+        token, subprotocol = handshake_token(scope)
+        if token is None:
+            return
+        scope['user'], scope['player'] = await get_player(token, scope['url_route']['kwargs'].get('room_name'))
+        scope['subprotocol'] = subprotocol
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:12
+
+from django.db import migrations, models
+
+
+# Schema drift of the baseline models, which were changed without migrations.
+# PlayerTask.round did not exist before, so existing rows are set to round 1.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_auto_20210315_2322'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='playertask',
+            name='paused',
+        ),
+        migrations.AddField(
+            model_name='playertask',
+            name='round',
+            field=models.PositiveSmallIntegerField(default=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='paused',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='customuser',
+            name='email',
+            field=models.EmailField(blank=True, max_length=254, verbose_name='email address'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:12
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicates(apps, schema_editor):
+    """
+    Keeps the first player of a user in a room and the first task of a player, deletes the other rows
+    """
+    Player = apps.get_model('core', 'Player')
+    PlayerTask = apps.get_model('core', 'PlayerTask')
+    for model, fields in ((Player, ('user', 'room')), (PlayerTask, ('player', 'task'))):
+        duplicates = model.objects.values(*fields).annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+        for duplicate in duplicates:
+            model.objects.filter(**{field: duplicate[field] for field in fields}) \
+                         .exclude(id=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+    # the deletes are committed before the constraints, Postgres can't alter tables with pending FK checks
+    atomic = False
+
+    dependencies = [
+        ('core', '0004_model_drift'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['room', 'active'], name='player_room_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playertask',
+            index=models.Index(fields=['player', 'round', 'status'], name='playertask_round_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['status'], name='room_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(condition=models.Q(_negated=True, status=4), fields=['name'], name='room_actual_name_idx'),
+        ),
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop, atomic=True),
+        migrations.AddConstraint(
+            model_name='player',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_user_room'),
+        ),
+        migrations.AddConstraint(
+            model_name='playertask',
+            constraint=models.UniqueConstraint(fields=('player', 'task'), name='unique_player_task'),
+        ),
+    ]
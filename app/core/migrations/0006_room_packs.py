@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='packs',
+            field=models.ManyToManyField(blank=True, related_name='rooms', to='core.Pack'),
+        ),
+    ]
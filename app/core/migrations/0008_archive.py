@@ -0,0 +1,67 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_user_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRoom',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=64)),
+                ('max_round', models.PositiveSmallIntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('start_work_at', models.DateTimeField(blank=True, null=True)),
+                ('finish_work_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Archived room',
+                'verbose_name_plural': 'Archived rooms',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedPlayer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=64)),
+                ('host', models.BooleanField(default=False)),
+                ('score', models.PositiveSmallIntegerField(default=0)),
+                ('likes', models.PositiveSmallIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='players', to='core.ArchivedRoom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_players', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived player',
+                'verbose_name_plural': 'Archived players',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round', models.PositiveSmallIntegerField()),
+                ('answer', models.CharField(blank=True, max_length=128)),
+                ('scope_cost', models.PositiveSmallIntegerField()),
+                ('likes', models.PositiveSmallIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='core.ArchivedRoom')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_answers', to='core.Task')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_answers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived answer',
+                'verbose_name_plural': 'Archived answers',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivedplayer',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_archived_user_room'),
+        ),
+    ]
@@ -1,22 +1,42 @@
+from contextlib import contextmanager
 from datetime import timedelta
+from random import choice
 
 from django.contrib.auth.base_user import BaseUserManager
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth import get_user_model
 from django.db.models.manager import Manager
-from django.db.models import F, Q, Count, IntegerField, Sum
+from django.db.models import F, Q, Count, Case, When, Value, Sum
 from django.utils import timezone
 from rest_framework_simplejwt.tokens import RefreshToken, Token
 
-from app.core.constants import PASSWORD_CHARS_NUMBER, DEFAULT_MAX_ROUND
+from app.core.constants import PASSWORD_CHARS_NUMBER, DEFAULT_MAX_ROUND, MAX_PLAYER_COUNT
+from app.core.leaderboard import leaderboard
+from app.core.lobby import lobby
+from app.core.mail import mail_queue, CONFIRMATION, RESET_PASSWORD
+from app.core.storage import get_redis
+from app.core.user_cache import user_cache
 from app.core.utils import generate_password
 from app.core.validators import CustomUsernameValidator
-from app.core.tasks import send_user_confirmation_email, send_user_reset_password_email
 
 
 # TODO limit CustomToken by timeout, update requirements (django + channels), make room name and user name primary key
 QUESTION_NUMBER_IN_ROUND = 2
+AUTH_FIELDS = {'username', 'email', 'is_active', 'is_staff', 'is_superuser', 'password', 'is_confirmed'}
+ROOM_COLORS_PREFIX = 'room_colors:'
+ROOM_COLORS_TTL = 24 * 60 * 60
+ROOM_FINISHED = 4  # Room.FINISHED, module level for the partial index of Room.Meta
+SEED_COLORS_SCRIPT = """
+if redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[1]) and #ARGV > 1 then
+    redis.call('SADD', KEYS[1], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+"""
+
+
+class JoinError(Exception):
+    pass
 
 
 class UserManager(BaseUserManager):
@@ -24,7 +44,7 @@ class UserManager(BaseUserManager):
         user = self.model(username=username, email=email.lower())
         user.set_password(password)
         user.save()
-        send_user_confirmation_email(user.id)
+        mail_queue.enqueue(CONFIRMATION, user.id)
         return user
 
     def create_superuser(self, username, email, password):
@@ -47,12 +67,141 @@ class RoomManager(Manager):
     def list_actual_rooms(self):
         return self.exclude(status=Room.FINISHED)
 
+    def lobby_rooms(self):
+        return self.list_actual_rooms().annotate(player_count=Count('players')) \
+                   .values('id', 'name', 'player_count', 'current_round', 'max_round', 'status', 'private')
+
+    def set_round(self, room_id, current_round):
+        self.filter(id=room_id).update(current_round=current_round)
+        lobby.change_room(room_id, current_round=current_round)
+
+    def abandoned(self, created_before):
+        """
+        Ids of the unfinished rooms created before created_before without active players
+        """
+        return self.list_actual_rooms().filter(created_at__lt=created_before).exclude(players__active=True) \
+                   .order_by('id').values_list('id', flat=True)
+
+    def finish_rooms(self, room_ids):
+        """
+        Bulk Room.finish_work: finishes the rooms that are not finished yet in one UPDATE, started games are
+        added to the stats of their players. Returns the ids of the finished rooms.
+        """
+        with transaction.atomic():
+            rooms = dict(self.select_for_update().filter(id__in=room_ids).exclude(status=Room.FINISHED)
+                             .values_list('id', 'start_work_at'))
+            if not rooms:
+                return []
+            self.filter(id__in=list(rooms)).update(status=Room.FINISHED, finish_work_at=timezone.now())
+            for room_id, start_work_at in rooms.items():
+                if start_work_at is not None:
+                    UserStats.objects.add_game(room_id)
+                lobby.remove_room(room_id)
+        return list(rooms)
+
+
+class PlayerTaskManager(Manager):
+    def used_task_ids(self, room_id):
+        return self.filter(player__room_id=room_id).values_list('task_id', flat=True)
+
+    def set_answers(self, player_id, current_round, answers):
+        if not answers:
+            return 0
+        return self.filter(player_id=player_id, round=current_round, task_id__in=[task_id for task_id, _ in answers]) \
+                   .update(answer=Case(*(When(task_id=task_id, then=Value(answer)) for task_id, answer in answers),
+                                       output_field=models.CharField()),
+                           status=PlayerTask.COMPLETED,
+                           answered_at=timezone.now())
+
+    def add_likes(self, player_id, room_id, current_round, votes):
+        if not votes:
+            return []
+        playertasks = self.filter(player__room_id=room_id, round=current_round,
+                                  task_id__in=[task_id for task_id, _ in votes]) \
+                          .values_list('task_id', 'player_id', 'id')
+        ids = {(task_id, author_id): playertask_id for task_id, author_id, playertask_id in playertasks}
+        likes = [PlayerTask.likes.through(playertask_id=ids[tuple(vote)], player_id=player_id)
+                 for vote in votes if tuple(vote) in ids]
+        return PlayerTask.likes.through.objects.bulk_create(likes, ignore_conflicts=True)
+
+    def create_round(self, tasks, current_round, scope_cost):
+        return self.bulk_create(self.model(task_id=task_id, player_id=player_id, round=current_round,
+                                           scope_cost=scope_cost)
+                                for player_id, player_tasks in tasks.items()
+                                for task_id, title in player_tasks)
+
+
+class ColorManager(Manager):
+    _palette = None
+
+    def palette(self):
+        """
+        Color ids, loaded once per process
+        """
+        if ColorManager._palette is None:
+            ColorManager._palette = list(self.order_by('id').values_list('id', flat=True))
+        return ColorManager._palette
+
+    def pop(self, room_id, used=None):
+        """
+        Pops a free color id of the room from a Redis set seeded once from the palette and the room players,
+        None when the room ran out of colors. used are the colors of the room players when the caller has them.
+        """
+        connection = get_redis()
+        free_key = f'{ROOM_COLORS_PREFIX}{room_id}'
+        color_id = connection.spop(free_key)
+        if color_id is None and not connection.exists(free_key + ':seeded'):
+            if used is None:
+                used = set(Player.objects.filter(room_id=room_id).values_list('color_id', flat=True))
+            free = [color_id for color_id in self.palette() if color_id not in used]
+            connection.eval(SEED_COLORS_SCRIPT, 2, free_key, free_key + ':seeded', ROOM_COLORS_TTL, *free)
+            color_id = connection.spop(free_key)
+        return None if color_id is None else int(color_id)
+
+    @contextmanager
+    def allocated(self, room_id, used=None):
+        """
+        Allocates a color for the block, a popped color goes back to the free set when the block raises
+        """
+        color_id = self.pop(room_id, used)
+        try:
+            yield choice(self.palette()) if color_id is None else color_id
+        except Exception:
+            if color_id is not None:
+                get_redis().sadd(f'{ROOM_COLORS_PREFIX}{room_id}', color_id)
+            raise
+
 
 class PlayerManager(Manager):
-    def create_player(self, user, room, username):
+    def create_player(self, user, room, username, host=False, used_colors=None):
         if not username:
             username = user.username
-        self.create(user=user, username=username, room=room, color=room.random_player_color)
+        with Color.objects.allocated(room.id, used_colors) as color_id, transaction.atomic():
+            player = self.create(user=user, username=username, room=room, host=host, color_id=color_id)
+        lobby.add_player(room.id)
+        return player
+
+    def join(self, user, room_id, username):
+        """
+        Adds the user to the room or returns the existing player, with the usernames of the room players.
+        The room row lock serializes joins of one room, the players are read once for the checks, the color
+        and the usernames.
+        """
+        with transaction.atomic():
+            room = Room.objects.select_for_update().get(id=room_id)
+            players = list(self.filter(room=room).values_list('user_id', 'username', 'color_id'))
+            usernames = [username for _, username, _ in players]
+            if user.id in {user_id for user_id, _, _ in players}:
+                return self.get(room=room, user=user), usernames
+            if room.status != Room.PENDING:
+                raise JoinError('The game already started')
+            if len(players) >= MAX_PLAYER_COUNT:
+                raise JoinError('The room is full')
+            player = self.create_player(user, room, username, used_colors={color_id for _, _, color_id in players})
+            return player, usernames + [player.username]
+
+    def deactivate(self, player_ids):
+        return self.filter(id__in=player_ids, active=True).update(active=False)
 
     def room_inf(self, room):
         return self.filter(room=room).values('id', username=F('username'))
@@ -65,6 +214,106 @@ class PlayerManager(Manager):
     def scores(self, room):
         return self.filter(room=room).values(userId=F('id'), username=F('username'), score=F('score'))
 
+    def scores_since(self, since):
+        """
+        Total scores per user of the games finished since, archived games included
+        """
+        scores = dict(self.filter(room__status=Room.FINISHED, room__finish_work_at__gte=since,
+                                  room__start_work_at__isnull=False)
+                          .values_list('user_id').annotate(Sum('score')))
+        for user_id, score in ArchivedPlayer.objects.scores_since(since).items():
+            scores[user_id] = scores.get(user_id, 0) + score
+        return scores
+
+    def update_scores(self, scores):
+        """
+        Sets the scores of all players in one UPDATE
+        """
+        if not scores:
+            return 0
+        return self.filter(id__in=list(scores)) \
+                   .update(score=Case(*(When(id=player_id, then=Value(score)) for player_id, score in scores.items()),
+                                      output_field=models.PositiveSmallIntegerField()))
+
+
+class UserStatsManager(Manager):
+    def add_game(self, room_id):
+        """
+        Adds a finished game to the stats of its players and to the leaderboards.
+        Players with the top score win, nobody wins a game without likes.
+        """
+        players = list(Player.objects.filter(room_id=room_id).annotate(likes=Count('playertasks__likes'))
+                                     .values_list('user_id', 'score', 'likes'))
+        if not players:
+            return
+        top_score = max(score for _, score, _ in players)
+        winners = [user_id for user_id, score, _ in players if top_score and score == top_score]
+        self.bulk_create([self.model(user_id=user_id) for user_id, _, _ in players], ignore_conflicts=True)
+        self.filter(user_id__in=[user_id for user_id, _, _ in players]) \
+            .update(games=F('games') + 1,
+                    wins=F('wins') + Case(When(user_id__in=winners, then=Value(1)), default=Value(0),
+                                          output_field=models.PositiveIntegerField()),
+                    likes=F('likes') + Case(*(When(user_id=user_id, then=Value(likes))
+                                              for user_id, _, likes in players),
+                                            default=Value(0), output_field=models.PositiveIntegerField()),
+                    score=F('score') + Case(*(When(user_id=user_id, then=Value(score))
+                                              for user_id, score, _ in players),
+                                            default=Value(0), output_field=models.PositiveIntegerField()))
+        leaderboard.add_scores({user_id: score for user_id, score, _ in players})
+
+    def scores(self):
+        return dict(self.values_list('user_id', 'score'))
+
+
+class ArchivedRoomManager(Manager):
+    def archivable(self, finished_before):
+        """
+        Ids of the rooms finished before finished_before that nobody is connected to, oldest first
+        """
+        return Room.objects.filter(status=Room.FINISHED) \
+                           .filter(Q(finish_work_at__lt=finished_before) | Q(finish_work_at__isnull=True)) \
+                           .exclude(players__active=True) \
+                           .order_by('id').values_list('id', flat=True)
+
+    def archive(self, room_ids):
+        """
+        Copies finished rooms with their players and answers to the archive tables and deletes the live rows
+        in one transaction, returns the ids of the archived rooms
+        """
+        with transaction.atomic():
+            rooms = list(Room.objects.select_for_update().filter(id__in=room_ids, status=Room.FINISHED))
+            if not rooms:
+                return []
+            ids = [room.id for room in rooms]
+            players = Player.objects.filter(room_id__in=ids).annotate(likes=Count('playertasks__likes')) \
+                                    .values_list('room_id', 'user_id', 'username', 'host', 'score', 'likes')
+            answers = PlayerTask.objects.filter(player__room_id__in=ids).annotate(like_count=Count('likes')) \
+                                        .values_list('player__room_id', 'player__user_id', 'task_id', 'round',
+                                                     'answer', 'scope_cost', 'like_count')
+            self.bulk_create(self.model(id=room.id, name=room.name, max_round=room.max_round,
+                                        created_at=room.created_at, start_work_at=room.start_work_at,
+                                        finish_work_at=room.finish_work_at)
+                             for room in rooms)
+            ArchivedPlayer.objects.bulk_create(ArchivedPlayer(room_id=room_id, user_id=user_id, username=username,
+                                                              host=host, score=score, likes=likes)
+                                               for room_id, user_id, username, host, score, likes in players)
+            ArchivedAnswer.objects.bulk_create(ArchivedAnswer(room_id=room_id, user_id=user_id, task_id=task_id,
+                                                              round=round_number, answer=answer,
+                                                              scope_cost=scope_cost, likes=likes)
+                                               for room_id, user_id, task_id, round_number, answer, scope_cost, likes
+                                               in answers)
+            Room.objects.filter(id__in=ids).delete()
+        return ids
+
+
+class ArchivedPlayerManager(Manager):
+    def scores_since(self, since):
+        """
+        Total scores per user of the archived games finished since
+        """
+        return dict(self.filter(room__finish_work_at__gte=since, room__start_work_at__isnull=False)
+                        .values_list('user_id').annotate(Sum('score')))
+
 
 class CustomUser(AbstractUser):
     rooms = models.ManyToManyField('core.Room', related_name='users', through='core.Player')
@@ -82,15 +331,21 @@ class CustomUser(AbstractUser):
     def __str__(self):
         return self.username
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or AUTH_FIELDS.intersection(update_fields):
+            user_cache.invalidate(self.id)
+
     def login_fill(self):
         self.last_login = timezone.now()
         self.save(update_fields=('last_login',))
 
     def send_confirmation(self):
-        send_user_confirmation_email(self.id)
+        mail_queue.enqueue(CONFIRMATION, self.id)
 
     def send_reset_password(self):
-        send_user_reset_password_email(self.id)
+        mail_queue.enqueue(RESET_PASSWORD, self.id)
 
     @property
     def tokens_pair(self):
@@ -135,6 +390,7 @@ class Task(models.Model):
 
 class Color(models.Model):
     name = models.CharField(max_length=6, unique=True)
+    objects = ColorManager()
 
     def __str__(self):
         return '#' + self.name
@@ -159,11 +415,13 @@ class PlayerTask(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     answered_at = models.DateTimeField(blank=True, null=True)
     finished_at = models.DateTimeField(blank=True, null=True)
-    objects = Manager()
+    objects = PlayerTaskManager()
 
     class Meta:
         verbose_name = 'Own task'
         verbose_name_plural = 'Own tasks'
+        indexes = (models.Index(fields=('player', 'round', 'status'), name='playertask_round_status_idx'),)
+        constraints = (models.UniqueConstraint(fields=('player', 'task'), name='unique_player_task'),)
 
     def set_answer(self, answer):
         self.answer = answer
@@ -182,7 +440,7 @@ class Room(models.Model):
     WORKING = 1
     ANSWERING = 2
     VOTING = 3
-    FINISHED = 4
+    FINISHED = ROOM_FINISHED
     STATUS_TYPE = (
         (PENDING, 'Pending'),
         (WORKING, 'Working'),
@@ -196,8 +454,8 @@ class Room(models.Model):
     max_round = models.PositiveSmallIntegerField(default=DEFAULT_MAX_ROUND)
     status = models.PositiveSmallIntegerField(default=PENDING, choices=STATUS_TYPE)
     private = models.BooleanField(default=True)
+    packs = models.ManyToManyField('core.Pack', related_name='rooms', blank=True)
     password = models.CharField(max_length=PASSWORD_CHARS_NUMBER, default=generate_password, blank=True, null=True)
-    timeout_task_id = models.CharField(blank=True, max_length=16)
     created_at = models.DateTimeField(auto_now_add=True)
     start_work_at = models.DateTimeField(blank=True, null=True)
     finish_work_at = models.DateTimeField(blank=True, null=True)
@@ -206,76 +464,38 @@ class Room(models.Model):
     class Meta:
         verbose_name = 'Room'
         verbose_name_plural = 'Rooms'
+        indexes = (models.Index(fields=('status',), name='room_status_idx'),
+                   models.Index(fields=('name',), name='room_actual_name_idx', condition=~Q(status=ROOM_FINISHED)))
 
     def __str__(self):
         return self.name
 
-    @property
-    def random_player_color(self):
-        return Color.objects.exclude(players__room=self).order_by('?')[0]
-
     @property
     def empty(self):
-        return self.players.filter(active=True).exists()
-
-    def is_has_user(self, user):
-        return self.players.filter(user=user).exists()
+        return not self.players.filter(active=True).exists()
 
     def start_work(self):
         self.status = self.WORKING
         self.start_work_at = timezone.now()
         self.save(update_fields=('status', 'start_work_at'))
+        lobby.change_room(self.id, status=self.status)
 
     def finish_work(self):
-        self.status = self.FINISHED
+        """
+        Finishes the room once, a started game is added to the stats of its players
+        """
         self.finish_work_at = timezone.now()
-        self.save(update_fields=('status', 'finish_work_at'))
+        with transaction.atomic():
+            finished = Room.objects.filter(id=self.id).exclude(status=self.FINISHED) \
+                                   .update(status=self.FINISHED, finish_work_at=self.finish_work_at)
+            if finished and self.start_work_at is not None:
+                UserStats.objects.add_game(self.id)
+        self.status = self.FINISHED
+        lobby.remove_room(self.id)
 
     def check_password(self, password):
         return self.password == password
 
-    def active_tasks(self):
-        return PlayerTask.objects.filter(player__room=self, status=PlayerTask.PENDING) \
-                                 .select_related('task') \
-                                 .values(channel_name=F('player__socket_channel_name'),
-                                         questionId=F('task_id'),
-                                         text=F('task__title'))
-
-    def has_unfinished_tasks(self):
-        return PlayerTask.objects.filter(player__room=self,
-                                         round=self.current_round,
-                                         status=PlayerTask.PENDING).exists()
-
-    def tasks_for_vote(self):
-        return PlayerTask.objects.filter(player__room=self, status=PlayerTask.COMPLETED) \
-                                 .select_related('task', 'player') \
-                                 .values('answer',
-                                         questionId=F('task_id'),
-                                         question=F('task__title'),
-                                         userID=F('player_id'),
-                                         username=F('player__username'))
-
-    def has_no_unvoted_tasks(self):
-        return PlayerTask.objects.filter(player__room=self,
-                                         round=self.current_round) \
-                                 .aggregate(total=Sum(F('likes__count'),  # doubtful
-                                                      output_field=IntegerField()))['total'] == self.players.count()
-
-        # return PlayerTask.objects.filter(player__room=self, round=self.current_round) \
-        #                          .annotate(Count('likes')) \
-        #                          .aggregate(total=Sum('likes_count'))['total'] == self.players.count()
-
-    def responding_players(self):
-        return Player.objects.filter(room=self,
-                                     round=self.current_round,
-                                     status=PlayerTask.COMPLETED) \
-                                 .annotate(task_count=Count('playertasks',
-                                                            filter=Q(round=self.current_round, status=PlayerTask.COMPLETED),
-                                                            output_field=IntegerField())) \
-                                 .filter(task_count=QUESTION_NUMBER_IN_ROUND).values_list('socket_channel_name',
-                                                                                          'id',
-                                                                                          'username')
-
 
 class Player(models.Model):
     username = models.CharField(max_length=64)
@@ -291,6 +511,8 @@ class Player(models.Model):
     class Meta:
         verbose_name = 'Player'
         verbose_name_plural = 'Players'
+        indexes = (models.Index(fields=('room', 'active'), name='player_room_active_idx'),)
+        constraints = (models.UniqueConstraint(fields=('user', 'room'), name='unique_user_room'),)
 
     def __str__(self):
         return f'{self.username} on room "{self.room.name}"'
@@ -307,3 +529,76 @@ class Player(models.Model):
                                .values('answer',
                                        questionId=F('task_id'),
                                        question=F('task__title'))
+
+
+class UserStats(models.Model):
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    games = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    likes = models.PositiveIntegerField(default=0)
+    score = models.PositiveIntegerField(default=0)
+    objects = UserStatsManager()
+
+    class Meta:
+        verbose_name = 'User stats'
+        verbose_name_plural = 'User stats'
+
+    def __str__(self):
+        return f'Stats of {self.user_id}'
+
+    @property
+    def average_score(self):
+        return self.score / self.games if self.games else 0
+
+
+class ArchivedRoom(models.Model):
+    """
+    Finished room moved out of the live tables, keeps the id of the room
+    """
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=64)
+    max_round = models.PositiveSmallIntegerField()
+    created_at = models.DateTimeField()
+    start_work_at = models.DateTimeField(blank=True, null=True)
+    finish_work_at = models.DateTimeField(blank=True, null=True)
+    objects = ArchivedRoomManager()
+
+    class Meta:
+        verbose_name = 'Archived room'
+        verbose_name_plural = 'Archived rooms'
+
+    def __str__(self):
+        return self.name
+
+
+class ArchivedPlayer(models.Model):
+    room = models.ForeignKey('core.ArchivedRoom', on_delete=models.CASCADE, related_name='players')
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='archived_players')
+    username = models.CharField(max_length=64)
+    host = models.BooleanField(default=False)
+    score = models.PositiveSmallIntegerField(default=0)
+    likes = models.PositiveSmallIntegerField(default=0)
+    objects = ArchivedPlayerManager()
+
+    class Meta:
+        verbose_name = 'Archived player'
+        verbose_name_plural = 'Archived players'
+        constraints = (models.UniqueConstraint(fields=('user', 'room'), name='unique_archived_user_room'),)
+
+    def __str__(self):
+        return f'{self.username} on archived room {self.room_id}'
+
+
+class ArchivedAnswer(models.Model):
+    room = models.ForeignKey('core.ArchivedRoom', on_delete=models.CASCADE, related_name='answers')
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='archived_answers')
+    task = models.ForeignKey('core.Task', on_delete=models.CASCADE, related_name='archived_answers')
+    round = models.PositiveSmallIntegerField()
+    answer = models.CharField(max_length=128, blank=True)
+    scope_cost = models.PositiveSmallIntegerField()
+    likes = models.PositiveSmallIntegerField(default=0)
+    objects = models.Manager()
+
+    class Meta:
+        verbose_name = 'Archived answer'
+        verbose_name_plural = 'Archived answers'
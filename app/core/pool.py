@@ -0,0 +1,184 @@
+from array import array
+from random import randrange
+from zlib import crc32
+
+from app.core.models import Task, PlayerTask
+from app.core.storage import get_redis
+
+ITEM_SIZE = array('I').itemsize
+HEADER_SIZE = ITEM_SIZE
+HEADER_BITS = HEADER_SIZE * 8
+SAMPLE_ATTEMPTS = 5
+ALL_TASKS = 'all'
+
+
+class TaskPool:
+    """
+    Task ids per pack cached in Redis as packed uint32 arrays sorted by id, plus a bitmap per room of the used
+    positions in the arrays of its packs, so a bitmap is as small as the pool.
+    Both start with a checksum of the arrays: a pool rebuilt with other tasks makes the room bitmaps rebuild.
+    Drawing tasks reads random array items and bits, so it costs O(tasks needed) instead of an anti-join.
+    """
+    POOL_KEY_PREFIX = 'task_pool:pack:'
+    USED_KEY_PREFIX = 'task_pool:used:'
+    POOL_TTL = 10 * 60
+    USED_TTL = 24 * 60 * 60
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def pool_key(self, pack_id):
+        return f'{self.POOL_KEY_PREFIX}{pack_id}'
+
+    def used_key(self, room_id):
+        return f'{self.USED_KEY_PREFIX}{room_id}'
+
+    def pools(self, pack_ids):
+        """
+        Returns (key, size) of the pools of pack_ids, all tasks are one pool when no packs are chosen,
+        and the checksum of their contents
+        """
+        pack_ids = pack_ids or [ALL_TASKS]
+        pipe = self.connection.pipeline()
+        for pack_id in pack_ids:
+            pipe.getrange(self.pool_key(pack_id), 0, HEADER_SIZE - 1)
+            pipe.strlen(self.pool_key(pack_id))
+        values = pipe.execute()
+        pools = []
+        checksums = array('I')
+        for pack_id, header, length in zip(pack_ids, values[::2], values[1::2]):
+            if len(header) == HEADER_SIZE:
+                checksum, size = array('I', header)[0], (length - HEADER_SIZE) // ITEM_SIZE
+            else:
+                checksum, size = self.build_pool(pack_id)
+            pools.append((self.pool_key(pack_id), size))
+            checksums.append(checksum)
+        return pools, crc32(checksums.tobytes())
+
+    def build_pool(self, pack_id):
+        tasks = Task.objects.order_by('id')
+        if pack_id != ALL_TASKS:
+            tasks = tasks.filter(pack_id=pack_id)
+        ids = array('I', tasks.values_list('id', flat=True).iterator())
+        checksum = crc32(ids.tobytes())
+        self.connection.set(self.pool_key(pack_id), array('I', [checksum]).tobytes() + ids.tobytes(),
+                            ex=self.POOL_TTL)
+        return checksum, len(ids)
+
+    def invalidate(self, pack_ids=()):
+        self.connection.delete(self.pool_key(ALL_TASKS), *[self.pool_key(pack_id) for pack_id in pack_ids])
+
+    def used(self, room_id, pools, checksum):
+        """
+        Returns the bitmap key of the room and whether it was just built from the room tasks
+        """
+        key = self.used_key(room_id)
+        header = array('I', [checksum]).tobytes()
+        if self.connection.getrange(key, 0, HEADER_SIZE - 1) == header:
+            return key, False
+        used_ids = set(PlayerTask.objects.used_task_ids(room_id))
+        pipe = self.connection.pipeline()
+        pipe.set(key, header, ex=self.USED_TTL)
+        if used_ids:
+            for position, task_id in enumerate(self.read_pools(pools)):
+                if task_id in used_ids:
+                    pipe.setbit(key, HEADER_BITS + position, 1)
+        pipe.execute()
+        return key, True
+
+    def mark_used(self, room_id, pack_ids, positions):
+        """
+        Marks the pool positions returned by sample as used
+        """
+        key, built = self.used(room_id, *self.pools(pack_ids))
+        pipe = self.connection.pipeline()
+        if not built:
+            for position in positions:
+                pipe.setbit(key, HEADER_BITS + position, 1)
+        pipe.expire(key, self.USED_TTL)
+        pipe.execute()
+
+    def available(self, room_id, pack_ids):
+        pools, checksum = self.pools(pack_ids)
+        key, _ = self.used(room_id, pools, checksum)
+        return sum(size for _, size in pools) - self.connection.bitcount(key, HEADER_SIZE, -1)
+
+    def sample(self, room_id, pack_ids, number):
+        """
+        Up to number random (id, title, pool position) of the packs not used in the room yet.
+        Tasks deleted while their pool was cached make the pools rebuild and the tasks redraw once.
+        """
+        chosen = self.draw(room_id, pack_ids, number)
+        titles = dict(Task.objects.filter(id__in=list(chosen)).values_list('id', 'title'))
+        if len(titles) < min(number, len(chosen)):
+            self.invalidate(pack_ids)
+            chosen = self.draw(room_id, pack_ids, number)
+            titles = dict(Task.objects.filter(id__in=list(chosen)).values_list('id', 'title'))
+        return [(task_id, titles[task_id], position) for task_id, position in chosen.items()
+                if task_id in titles][:number]
+
+    def draw(self, room_id, pack_ids, number):
+        """
+        Returns {task id: pool position} of at least number unused tasks unless the pools run out
+        """
+        pools, checksum = self.pools(pack_ids)
+        pools = [(key, size) for key, size in pools if size]
+        total = sum(size for _, size in pools)
+        used_key, _ = self.used(room_id, pools, checksum)
+        chosen = {}
+        for _ in range(SAMPLE_ATTEMPTS):
+            if not total:
+                break
+            candidates = [(task_id, position) for task_id, position
+                          in self.read_items(pools, {randrange(total) for _ in range(number * 2)})
+                          if task_id not in chosen]
+            pipe = self.connection.pipeline()
+            for task_id, position in candidates:
+                pipe.getbit(used_key, HEADER_BITS + position)
+            chosen.update(candidate for candidate, bit in zip(candidates, pipe.execute()) if not bit)
+            if len(chosen) >= number:
+                break
+        if len(chosen) < number:
+            chosen.update(self.unused_items(pools, used_key, number - len(chosen), chosen))
+        return chosen
+
+    def read_items(self, pools, positions):
+        """
+        Returns (task id, position) of the items at positions of the concatenated pools
+        """
+        positions = sorted(positions)
+        pipe = self.connection.pipeline()
+        for position in positions:
+            offset = position
+            for key, size in pools:
+                if offset < size:
+                    pipe.getrange(key, HEADER_SIZE + offset * ITEM_SIZE, HEADER_SIZE + (offset + 1) * ITEM_SIZE - 1)
+                    break
+                offset -= size
+        return [(array('I', item)[0], position)
+                for position, item in zip(positions, pipe.execute()) if len(item) == ITEM_SIZE]
+
+    def read_pools(self, pools):
+        for key, _ in pools:
+            yield from array('I', (self.connection.get(key) or b'')[HEADER_SIZE:])
+
+    def unused_items(self, pools, used_key, number, exclude):
+        """
+        Fallback for nearly exhausted pools: reads whole arrays and the bitmap
+        """
+        used = (self.connection.get(used_key) or b'')[HEADER_SIZE:]
+        items = []
+        for position, task_id in enumerate(self.read_pools(pools)):
+            byte = position // 8
+            if task_id not in exclude and (byte >= len(used) or not used[byte] & (128 >> position % 8)):
+                items.append((task_id, position))
+                if len(items) == number:
+                    return items
+        return items
+
+
+task_pool = TaskPool()
@@ -0,0 +1,282 @@
+from random import shuffle
+
+from django.db import transaction
+
+from app.core.authentication import CachedJWTAuthentication
+from app.core.constants import MIN_PLAYER_NUMBER, SCOPE_ORDER, ANSWERING_DURATION, VOTE_DURATION
+from app.core.encoding import dumps
+from app.core.event_log import event_log
+from app.core.heartbeat import heartbeat
+from app.core.models import Room, PlayerTask, Player
+from app.core.pool import task_pool
+from app.core.state import RoomState, change_room_state
+from app.core.timers import room_timers
+from app.core.utils import vote_event, greeting_event, error_event, start_event, define_event, winner_event, \
+    answer_accepted_event, score_event, pause_event, resume_event, snapshot_event
+
+GROUP_PREFIX = 'game_'
+ANSWERING_TIMER = 'answering'
+VOTING_TIMER = 'voting'
+
+jwt_authentication = CachedJWTAuthentication()
+
+
+class Outbox:
+    """
+    Messages produced by one protocol handler, in sending order.
+    Broadcasts and direct messages are also kept in logged until they are written to the room event log.
+    """
+    REPLY = 'reply'
+    GROUP = 'group'
+    DIRECT = 'direct'
+
+    def __init__(self):
+        self.messages = []
+        self.logged = []
+
+    def reply(self, data):
+        self.messages.append((self.REPLY, None, data))
+
+    def broadcast(self, data):
+        self.messages.append((self.GROUP, None, data))
+        self.logged.append((None, data))
+
+    def send(self, channels, data):
+        """
+        Sends the same data to {player id: channel name}
+        """
+        for channel_name in channels.values():
+            self.messages.append((self.DIRECT, channel_name, data))
+        self.logged.append((list(channels), data))
+
+    def deliveries(self):
+        """
+        Encoded (kind, text) pairs in sending order, data shared by several messages is encoded once.
+        Consecutive direct messages are merged into one (DIRECT, [(channel name, text), ...]) to send them at once.
+        """
+        texts = {}
+        deliveries = []
+        for kind, channel_name, data in self.messages:
+            if id(data) not in texts:
+                texts[id(data)] = dumps(data)
+            if kind != self.DIRECT:
+                deliveries.append((kind, texts[id(data)]))
+            elif deliveries and deliveries[-1][0] == self.DIRECT:
+                deliveries[-1][1].append((channel_name, texts[id(data)]))
+            else:
+                deliveries.append((kind, [(channel_name, texts[id(data)])]))
+        return deliveries
+
+
+class RoomProtocol:
+    """
+    Game room protocol shared by the sync and async consumers.
+    Handlers do all their DB work in one call and return an Outbox, the consumer delivers it afterwards.
+    """
+    HANDLERS = {
+        'pause': 'pause',
+        'resume': 'resume',
+        'greeting': 'greeting',
+        'start': 'start',
+        'answer': 'answer',
+        'voteList': 'vote',
+    }
+    player_id = None
+
+    @classmethod
+    def for_room(cls, room_id):
+        protocol = cls()
+        protocol.room_id = room_id
+        protocol.room_name = RoomState.load(room_id).name
+        protocol.room_group_name = GROUP_PREFIX + protocol.room_name
+        return protocol
+
+    def leave_room(self):
+        if self.player_id is None:
+            return
+        Player.objects.filter(id=self.player_id).update(active=False)
+        heartbeat.forget(self.player_id)
+        state, empty = change_room_state(self.room_id, lambda state: state.leave(self.player_id))
+        if empty:
+            room_timers.cancel(self.room_id)
+            Room.objects.get(id=self.room_id).finish_work()
+
+    def handle_event(self, data):
+        """
+        Every event of the player refreshes its heartbeat
+        """
+        outbox = Outbox()
+        if self.player_id is not None and not heartbeat.touch(self.player_id):
+            self.revive(outbox)
+        handler = self.HANDLERS.get(data['eventType'])
+        if handler:
+            getattr(self, handler)(outbox, data)
+        self.record(outbox)
+        return outbox
+
+    def fan_out(self, outbox, state, player_ids, data):
+        """
+        Sends the same data to player_ids, as one broadcast when they are all the connected players
+        """
+        if not player_ids:
+            return
+        connected = {player_id for player_id, player in state.players.items() if player['active']}
+        if connected.issubset(player_ids):
+            outbox.broadcast(data)
+        else:
+            outbox.send({player_id: state.channel(player_id) for player_id in player_ids}, data)
+
+    def record(self, outbox):
+        entries, outbox.logged = outbox.logged, []
+        event_log.append(self.room_id, entries)
+
+    def expire(self, outbox, event):
+        phase, round_number = event.split(':')
+        if phase == ANSWERING_TIMER:
+            state, closed = change_room_state(self.room_id, lambda state: state.close_answering(int(round_number)))
+            if closed:
+                self.answering_over(outbox, state)
+        elif phase == VOTING_TIMER:
+            state, closed = change_room_state(self.room_id, lambda state: state.close_voting(int(round_number)))
+            if closed:
+                self.round_over(outbox, state)
+        self.record(outbox)
+
+    def answering_over(self, outbox, state):
+        room_timers.schedule(self.room_id, f'{VOTING_TIMER}:{state.current_round}', VOTE_DURATION)
+        outbox.broadcast(vote_event(state.vote_list()))
+
+    def round_over(self, outbox, state):
+        room_timers.cancel(self.room_id)
+        Player.objects.update_scores({player_id: player['score'] for player_id, player in state.players.items()})
+        if state.status == Room.FINISHED:
+            Room.objects.get(id=self.room_id).finish_work()
+            outbox.broadcast(winner_event(state.winner(), state.scores()))
+        else:
+            Room.objects.set_round(self.room_id, state.current_round)
+            outbox.broadcast(score_event(state.scores()))
+
+    def pause(self, outbox, data):
+        change_room_state(self.room_id, lambda state: state.set_paused(True))
+        room_timers.pause(self.room_id)
+        Room.objects.filter(id=self.room_id).update(paused=True)
+        outbox.broadcast(pause_event())
+
+    def resume(self, outbox, data):
+        change_room_state(self.room_id, lambda state: state.set_paused(False))
+        room_timers.resume(self.room_id)
+        Room.objects.filter(id=self.room_id).update(paused=False)
+        outbox.broadcast(resume_event())
+
+    def greeting(self, outbox, data):
+        token = jwt_authentication.get_validated_token(data['token'])
+        player = Player.objects.get(user=jwt_authentication.get_user(token), room_id=self.room_id)
+        self.join(outbox, player, data.get('version'))
+
+    def join(self, outbox, player, version=None):
+        """
+        Only a new player is announced to the room. A client that sends the last event version it saw
+        gets the missed events or a snapshot of the room, other clients get the events of the current phase.
+        """
+        self.player_id = player.id
+        Player.objects.filter(id=player.id).update(socket_channel_name=self.channel_name, active=True)
+        heartbeat.touch(player.id)
+        state, joined = change_room_state(self.room_id, lambda state: state.join(player, self.channel_name))
+        if version is not None:
+            outbox.reply(define_event(player.id, player.username, player.host))
+            self.catch_up(outbox, state, version)
+            if joined:
+                outbox.broadcast(greeting_event(state.name, state.password, state.player_list()))
+        elif state.status == Room.PENDING:
+            outbox.reply(define_event(player.id, player.username, player.host))
+            if joined:
+                outbox.broadcast(greeting_event(state.name, state.password, state.player_list()))
+            else:
+                outbox.reply(greeting_event(state.name, state.password, state.player_list()))
+        else:
+            if state.status == Room.ANSWERING:
+                outbox.reply(start_event(state.questions(player.id), room_timers.remaining(self.room_id)))
+            elif state.status == Room.VOTING:
+                outbox.reply(vote_event(state.vote_list()))
+            else:
+                outbox.reply(define_event(player.id, player.username, player.host))
+            if state.paused:
+                outbox.reply(pause_event())
+        self.record(outbox)
+
+    def revive(self, outbox):
+        """
+        A player reaped while its socket was only slow joins the room again
+        """
+        player = Player.objects.filter(id=self.player_id, active=False).first()
+        if player is not None:
+            self.join(outbox, player)
+
+    def catch_up(self, outbox, state, version):
+        current, events = event_log.since(self.room_id, version, self.player_id)
+        if events is None or not current:
+            outbox.reply(snapshot_event(current, state.snapshot(self.player_id), room_timers.remaining(self.room_id)))
+            return
+        for event in events:
+            outbox.reply(event)
+
+    def start(self, outbox, data):
+        state = RoomState.load(self.room_id)
+        players = list(state.players)
+        player_count = len(players)
+        if state.status not in (Room.PENDING, Room.WORKING):
+            outbox.reply(error_event('The round already started'))
+            return
+        if player_count < MIN_PLAYER_NUMBER:
+            outbox.reply(error_event('Amount of users smaller than ' + str(MIN_PLAYER_NUMBER)))
+            return
+        if state.status == Room.PENDING and \
+                task_pool.available(self.room_id, state.packs) < player_count * state.max_round:
+            outbox.reply(error_event('Not enough tasks for this game'))
+            return
+        sampled = task_pool.sample(self.room_id, state.packs, player_count)
+        game_tasks = [[task_id, title] for task_id, title, position in sampled]
+        if len(game_tasks) < player_count:
+            outbox.reply(error_event('Not enough tasks for this game'))
+            return
+        repetitive_tasks = game_tasks.copy()
+        repetitive_tasks.append(repetitive_tasks.pop(0))
+        shuffle(players)
+        tasks = {player_id: [game_tasks[i], repetitive_tasks[i]] for i, player_id in enumerate(players)}
+        scope_cost = state.current_round * (player_count - 1) * SCOPE_ORDER
+        previous_status = state.status
+        state, assigned = change_room_state(self.room_id, lambda state: state.assign(tasks, scope_cost))
+        if not assigned:
+            outbox.reply(error_event('The round already started'))
+            return
+        try:
+            with transaction.atomic():
+                PlayerTask.objects.create_round(tasks, state.current_round, scope_cost)
+                if state.current_round == 1:
+                    Room.objects.get(id=self.room_id).start_work()
+        except Exception:
+            change_room_state(self.room_id, lambda state: state.unassign(tasks, previous_status))
+            raise
+        task_pool.mark_used(self.room_id, state.packs, [position for task_id, title, position in sampled])
+        room_timers.schedule(self.room_id, f'{ANSWERING_TIMER}:{state.current_round}', ANSWERING_DURATION)
+        for player_id in players:
+            outbox.send({player_id: state.channel(player_id)}, start_event(state.questions(player_id)))
+
+    def answer(self, outbox, data):
+        answers = [(answer['questionId'], answer['answer']) for answer in data['answer']]
+        state, (accepted, finished) = change_room_state(self.room_id,
+                                                        lambda state: state.answer(self.player_id, answers))
+        PlayerTask.objects.set_answers(self.player_id, state.current_round, accepted)
+        players = state.responding_players()
+        data = [{'id': player_id, 'username': state.players[player_id]['username']} for player_id in players]
+        self.fan_out(outbox, state, players, answer_accepted_event(data))
+        if finished:
+            self.answering_over(outbox, state)
+
+    def vote(self, outbox, data):
+        votes = [(vote['questionId'], vote['voteId']) for vote in data['votes']]
+        state, (round_number, accepted, finished) = change_room_state(
+            self.room_id, lambda state: (state.current_round, *state.vote(self.player_id, votes)))
+        PlayerTask.objects.add_likes(self.player_id, self.room_id, round_number, accepted)
+        if finished:
+            self.round_over(outbox, state)
@@ -0,0 +1,42 @@
+from copy import deepcopy
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from app.core.storage import get_redis
+
+
+def channel_layers_on_test_db():
+    """
+    CHANNEL_LAYERS with the Redis hosts moved to REDIS_TEST_DB, so test group sends never reach live sockets
+    """
+    layers = deepcopy(settings.CHANNEL_LAYERS)
+    for layer in layers.values():
+        config = layer.get('CONFIG', {})
+        if 'hosts' in config:
+            config['hosts'] = [{'address': (settings.REDIS_HOST, settings.REDIS_PORT), 'db': settings.REDIS_TEST_DB}]
+    return layers
+
+
+class RedisTestRunner(DiscoverRunner):
+    """
+    Runs the tests against REDIS_TEST_DB, the Redis counterpart of the test database.
+    The app keys and the channel layer groups both live there, the database is flushed before and after the run,
+    the keys of REDIS_DB are never touched.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        if settings.REDIS_TEST_DB == settings.REDIS_DB:
+            raise ImproperlyConfigured('REDIS_TEST_DB must differ from REDIS_DB')
+        self.redis_settings = override_settings(REDIS_DB=settings.REDIS_TEST_DB,
+                                                CHANNEL_LAYERS=channel_layers_on_test_db())
+        self.redis_settings.enable()
+        get_redis().flushdb()
+
+    def teardown_test_environment(self, **kwargs):
+        get_redis().flushdb()
+        self.redis_settings.disable()
+        super().teardown_test_environment(**kwargs)
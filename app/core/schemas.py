@@ -1,7 +1,7 @@
 greeting_schema = {
   "type": "object",
   "properties": {
-    "event_type": {
+    "eventType": {
       "const": "greeting"
     },
     "timestamp": {
@@ -9,10 +9,14 @@ greeting_schema = {
     },
     "token": {
       "type": "string"
+    },
+    "version": {
+      "type": "integer",
+      "minimum": 0
     }
   },
   "required": [
-    "event_type",
+    "eventType",
     "timestamp",
     "token"
   ]
@@ -21,7 +25,7 @@ greeting_schema = {
 start_schema = {
   "type": "object",
   "properties": {
-    "event_type": {
+    "eventType": {
       "const": "start"
     },
     "timestamp": {
@@ -29,7 +33,7 @@ start_schema = {
     },
   },
   "required": [
-    "event_type",
+    "eventType",
     "timestamp"
   ]
 }
@@ -37,35 +41,33 @@ start_schema = {
 answer_schema = {
   "type": "object",
   "properties": {
-    "event_type": {
+    "eventType": {
       "const": "answer"
     },
     "answer": {
       "type": "array",
-      "items": [
-        {
-          "type": "object",
-          "properties": {
-            "questionId": {
-              "type": "integer"
-            },
-            "answer": {
-              "type": "string"
-            }
+      "items": {
+        "type": "object",
+        "properties": {
+          "questionId": {
+            "type": "integer"
           },
-          "required": [
-            "questionId",
-            "answer"
-          ]
-        }
-      ]
+          "answer": {
+            "type": "string"
+          }
+        },
+        "required": [
+          "questionId",
+          "answer"
+        ]
+      }
     },
     "timestamp": {
       "type": "number"
     },
   },
   "required": [
-    "event_type",
+    "eventType",
     "answer",
     "timestamp"
   ]
@@ -74,38 +76,85 @@ answer_schema = {
 vote_schema = {
   "type": "object",
   "properties": {
-    "event_type": {
+    "eventType": {
       "const": "voteList"
     },
     "votes": {
       "type": "array",
-      "items": [
-        {
-          "type": "object",
-          "properties": {
-            "questionId": {
-              "type": "integer"
-            },
-            "voteId": {
-              "type": "integer"
-            }
+      "items": {
+        "type": "object",
+        "properties": {
+          "questionId": {
+            "type": "integer"
           },
-          "required": [
-            "questionId",
-            "voteId"
-          ]
-        }
-      ]
+          "voteId": {
+            "type": "integer"
+          }
+        },
+        "required": [
+          "questionId",
+          "voteId"
+        ]
+      }
     },
     "timestamp": {
       "type": "number"
     },
   },
   "required": [
-    "event_type",
+    "eventType",
     "votes",
     "timestamp"
   ]
 }
 
-EVENTS_SCHEMAS = (greeting_schema, start_schema, answer_schema, vote_schema)
+pause_schema = {
+  "type": "object",
+  "properties": {
+    "eventType": {
+      "const": "pause"
+    },
+    "timestamp": {
+      "type": "number"
+    },
+  },
+  "required": [
+    "eventType",
+    "timestamp"
+  ]
+}
+
+resume_schema = {
+  "type": "object",
+  "properties": {
+    "eventType": {
+      "const": "resume"
+    },
+    "timestamp": {
+      "type": "number"
+    },
+  },
+  "required": [
+    "eventType",
+    "timestamp"
+  ]
+}
+
+is_alive_schema = {
+  "type": "object",
+  "properties": {
+    "eventType": {
+      "const": "isAlive"
+    },
+    "timestamp": {
+      "type": "number"
+    },
+  },
+  "required": [
+    "eventType",
+    "timestamp"
+  ]
+}
+
+EVENTS_SCHEMAS = (greeting_schema, start_schema, answer_schema, vote_schema, pause_schema, resume_schema,
+                  is_alive_schema)
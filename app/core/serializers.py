@@ -1,9 +1,11 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework_simplejwt.exceptions import TokenError
 
 from app.core.constants import MAX_PLAYER_COUNT
-from app.core.models import Room, Player, CustomToken
+from app.core.lobby import lobby
+from app.core.models import Room, Player, Pack, CustomToken, JoinError, UserStats
 
 
 class SigUpSerializer(serializers.ModelSerializer):
@@ -138,27 +140,25 @@ class ResetPasswordSerializer(serializers.ModelSerializer):
 
 class CreateRoomSerializer(serializers.ModelSerializer):
     username = serializers.CharField(allow_blank=True)
+    packs = serializers.PrimaryKeyRelatedField(queryset=Pack.objects.all(), many=True, required=False)
 
     class Meta:
         model = Room
-        fields = ('username', 'name', 'max_round')
+        fields = ('username', 'name', 'max_round', 'packs')
 
     def validate_name(self, value):
         if self.Meta.model.objects.list_actual_rooms().filter(name=value).exists():
             raise serializers.ValidationError('A room with that name already exists.')
         return value
 
+    @transaction.atomic
     def create(self, validated_data):
         username = validated_data.pop('username')
+        packs = validated_data.pop('packs', [])
         room = self.Meta.model.objects.create(**validated_data)
-        user = self.context.get('request').user
-        if not username:
-            username = user.username
-        Player.objects.create(user=user,
-                              username=username,
-                              room=room,
-                              host=True,
-                              color=room.random_player_color)
+        room.packs.set(packs)
+        lobby.add_room(room)
+        Player.objects.create_player(self.context.get('request').user, room, username, host=True)
         return room
 
     def to_representation(self, instance):
@@ -178,23 +178,23 @@ class ConnectRoomSerializer(serializers.ModelSerializer):
 
     def validate(self, attrs):
         try:
-            self.instance = self.Meta.model.objects.get(name=attrs.get('name'))
+            self.instance = self.Meta.model.objects.list_actual_rooms().get(name=attrs.get('name'))
         except self.Meta.model.DoesNotExist:
             raise serializers.ValidationError({'name': 'No room with such name'})
         if self.instance.private and not self.instance.check_password(attrs.get('password')):
             raise serializers.ValidationError({'password': ['Incorrect password']})
-        if not self.instance.is_has_user(self.context.get('request').user) and self.instance.status != Room.PENDING:
-            raise serializers.ValidationError('The game already started')
         return attrs
 
     def update(self, instance, validated_data):
-        user = self.context.get('request').user
-        if not Player.objects.filter(user=user, room=instance).exists():
-            Player.objects.create_player(user, instance, validated_data.get('username'))
+        try:
+            _, self.usernames = Player.objects.join(self.context.get('request').user, instance.id,
+                                                    validated_data.get('username'))
+        except JoinError as error:
+            raise serializers.ValidationError(str(error))
         return instance
 
     def to_representation(self, instance):
-        data = {'name': instance.name, 'players': instance.players.values_list('username', flat=True)}
+        data = {'name': instance.name, 'players': self.usernames}
         if instance.private:
             data['password'] = instance.password
         return data
@@ -211,6 +211,20 @@ class RoomSerializer(serializers.ModelSerializer):
         return dict(Room.STATUS_TYPE).get(obj.status)
 
 
+class PackSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Pack
+        fields = ('id', 'title')
+
+
+class UserStatsSerializer(serializers.ModelSerializer):
+    average_score = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = UserStats
+        fields = ('games', 'wins', 'likes', 'score', 'average_score')
+
+
 class MeSerializer(serializers.ModelSerializer):
     class Meta:
         model = get_user_model()
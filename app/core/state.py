@@ -0,0 +1,266 @@
+import json
+
+from app.core.models import Room, PlayerTask
+from app.core.storage import get_redis
+
+
+class RoomState:
+    """
+    Authoritative state of a running room. It lives in Redis as one key per room, handlers read and change it
+    instead of reloading the room from the DB, the DB only receives the writes afterwards.
+    """
+    KEY_PREFIX = 'room_state:'
+    TTL = 24 * 60 * 60
+
+    def __init__(self, room_id, name, password, status, paused, current_round, max_round,
+                 players=None, tasks=None, answers=None, votes=None, pending=0, packs=None, scope_cost=0,
+                 round_scores=None):
+        self.room_id = room_id
+        self.name = name
+        self.password = password
+        self.status = status
+        self.paused = paused
+        self.current_round = current_round
+        self.max_round = max_round
+        self.players = players or {}  # player id -> {'username', 'channel', 'active', 'host', 'score'}
+        self.tasks = tasks or {}  # player id -> [[task id, title], ...] of the current round
+        self.answers = answers or {}  # player id -> {task id: answer}
+        self.votes = votes or {}  # voter id -> [[task id, player id], ...]
+        self.pending = pending  # tasks of the current round without answer
+        self.packs = packs or []  # pack ids to draw tasks from, all tasks if empty
+        self.scope_cost = scope_cost  # points of an answer liked by every other player of the round
+        self.round_scores = round_scores or {}  # player id -> points of the last finished round
+
+    @classmethod
+    def key(cls, room_id):
+        return f'{cls.KEY_PREFIX}{room_id}'
+
+    @classmethod
+    def load(cls, room_id, connection=None):
+        data = (connection or get_redis()).get(cls.key(room_id))
+        if data is None:
+            return cls.from_db(room_id)
+        return cls.loads(data)
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        data['players'] = {int(key): value for key, value in data['players'].items()}
+        data['tasks'] = {int(key): value for key, value in data['tasks'].items()}
+        data['answers'] = {int(key): {int(task_id): answer for task_id, answer in value.items()}
+                           for key, value in data['answers'].items()}
+        data['votes'] = {int(key): value for key, value in data['votes'].items()}
+        data['round_scores'] = {int(key): value for key, value in data.get('round_scores', {}).items()}
+        return cls(**data)
+
+    def dumps(self):
+        return json.dumps(self.__dict__, separators=(',', ':'))
+
+    @classmethod
+    def from_db(cls, room_id):
+        room = Room.objects.get(id=room_id)
+        state = cls(room.id, room.name, room.password, room.status, room.paused, room.current_round, room.max_round,
+                    packs=list(room.packs.values_list('id', flat=True)))
+        for player in room.players.all():
+            state.players[player.id] = {'username': player.username, 'channel': player.socket_channel_name,
+                                        'active': player.active, 'host': player.host, 'score': player.score}
+        playertasks = PlayerTask.objects.filter(player__room=room, round=room.current_round) \
+                                        .values_list('player_id', 'task_id', 'task__title', 'status', 'answer',
+                                                     'scope_cost')
+        for player_id, task_id, title, status, answer, scope_cost in playertasks:
+            state.scope_cost = scope_cost
+            state.tasks.setdefault(player_id, []).append([task_id, title])
+            if status == PlayerTask.PENDING:
+                state.pending += 1
+            else:
+                state.answers.setdefault(player_id, {})[task_id] = answer
+        likes = PlayerTask.likes.through.objects.filter(playertask__player__room=room,
+                                                        playertask__round=room.current_round) \
+                                                .values_list('player_id', 'playertask__task_id',
+                                                             'playertask__player_id')
+        for voter_id, task_id, player_id in likes:
+            state.votes.setdefault(voter_id, []).append([task_id, player_id])
+        if room.status == Room.WORKING and state.tasks:
+            state.status = Room.ANSWERING if state.pending else Room.VOTING
+        return state
+
+    def join(self, player, channel_name):
+        """
+        Returns whether the player is new to the room
+        """
+        joined = player.id not in self.players
+        self.players[player.id] = {'username': player.username, 'channel': channel_name,
+                                   'active': True, 'host': player.host, 'score': player.score}
+        return joined
+
+    def leave(self, player_id):
+        if player_id in self.players:
+            self.players[player_id]['active'] = False
+        return not any(player['active'] for player in self.players.values())
+
+    def assign(self, tasks, scope_cost):
+        if self.status not in (Room.PENDING, Room.WORKING):
+            return False
+        self.tasks = tasks
+        self.scope_cost = scope_cost
+        self.answers = {}
+        self.votes = {}
+        self.pending = sum(len(player_tasks) for player_tasks in tasks.values())
+        self.status = Room.ANSWERING
+        return True
+
+    def unassign(self, tasks, status):
+        """
+        Undoes assign(tasks) when the round could not be written to the DB, status is the one before assign
+        """
+        if self.status != Room.ANSWERING or self.tasks != tasks:
+            return False
+        self.tasks = {}
+        self.pending = 0
+        self.status = status
+        return True
+
+    def answer(self, player_id, answers):
+        """
+        Returns newly accepted (task id, answer) pairs and whether the answering phase is over
+        """
+        if self.status != Room.ANSWERING:
+            return [], False
+        own_tasks = {task_id for task_id, title in self.tasks.get(player_id, ())}
+        player_answers = self.answers.setdefault(player_id, {})
+        accepted = []
+        for task_id, answer in answers:
+            if task_id in own_tasks and task_id not in player_answers:
+                player_answers[task_id] = answer
+                accepted.append((task_id, answer))
+        self.pending -= len(accepted)
+        if accepted and not self.pending:
+            self.status = Room.VOTING
+            return accepted, True
+        return accepted, False
+
+    def vote(self, player_id, votes):
+        """
+        Returns accepted (task id, player id) votes and whether the round is over.
+        An answer counts once per voter and nobody can like their own answer.
+        """
+        if self.status != Room.VOTING or player_id in self.votes:
+            return [], False
+        accepted = []
+        for task_id, author_id in votes:
+            vote = [task_id, author_id]
+            if author_id != player_id and task_id in self.answers.get(author_id, {}) and vote not in accepted:
+                accepted.append(vote)
+        self.votes[player_id] = accepted
+        if any(voter_id not in self.votes for voter_id in self.voters()):
+            return accepted, False
+        self.finish_round()
+        return accepted, True
+
+    def voters(self):
+        """
+        Active players with tasks in the current round, the round ends early once all of them voted
+        """
+        return [player_id for player_id in self.tasks if self.players.get(player_id, {}).get('active')]
+
+    def close_answering(self, round_number):
+        if self.status != Room.ANSWERING or self.current_round != round_number:
+            return False
+        self.status = Room.VOTING
+        return True
+
+    def close_voting(self, round_number):
+        if self.status != Room.VOTING or self.current_round != round_number:
+            return False
+        self.finish_round()
+        return True
+
+    def finish_round(self):
+        """
+        Scores the round in one pass over the votes, a like is worth an equal share of scope_cost
+        """
+        like_cost = self.scope_cost // max(len(self.tasks) - 1, 1)
+        self.round_scores = dict.fromkeys(self.players, 0)
+        for player_votes in self.votes.values():
+            for task_id, author_id in player_votes:
+                self.round_scores[author_id] += like_cost
+        for player_id, points in self.round_scores.items():
+            self.players[player_id]['score'] += points
+        if self.current_round >= self.max_round:
+            self.status = Room.FINISHED
+        else:
+            self.current_round += 1
+            self.status = Room.WORKING
+
+    def set_paused(self, paused):
+        self.paused = paused
+
+    def player_list(self):
+        return [{'id': player_id, 'username': player['username']} for player_id, player in self.players.items()]
+
+    def channel(self, player_id):
+        return self.players[player_id]['channel']
+
+    def questions(self, player_id):
+        answered = self.answers.get(player_id, {})
+        return [{'questionId': task_id, 'text': title} for task_id, title in self.tasks.get(player_id, ())
+                if task_id not in answered]
+
+    def responding_players(self):
+        return [player_id for player_id, player_tasks in self.tasks.items()
+                if len(self.answers.get(player_id, ())) == len(player_tasks)]
+
+    def vote_list(self):
+        grouped = {}
+        for player_id, player_tasks in self.tasks.items():
+            answers = self.answers.get(player_id, {})
+            for task_id, title in player_tasks:
+                if task_id in answers:
+                    question = grouped.setdefault(task_id, {'questionId': task_id, 'question': title, 'answers': []})
+                    question['answers'].append({'answer': answers[task_id], 'userID': player_id,
+                                                'username': self.players[player_id]['username']})
+        return list(grouped.values())
+
+    def scores(self):
+        """
+        Scoreboard ranked by score, equal scores share a rank
+        """
+        ranked = sorted(self.players.items(), key=lambda item: -item[1]['score'])
+        scores = []
+        for position, (player_id, player) in enumerate(ranked, 1):
+            rank = scores[-1]['rank'] if scores and scores[-1]['score'] == player['score'] else position
+            scores.append({'rank': rank, 'userId': player_id, 'username': player['username'],
+                           'score': player['score'], 'roundScore': self.round_scores.get(player_id, 0)})
+        return scores
+
+    def snapshot(self, player_id):
+        """
+        What a client needs to redraw the room, the questions or the vote list depending on the phase
+        """
+        snapshot = {'status': self.status, 'round': self.current_round, 'maxRound': self.max_round,
+                    'paused': self.paused, 'users': self.player_list(), 'scores': self.scores()}
+        if self.status == Room.ANSWERING:
+            snapshot['questions'] = self.questions(player_id)
+        elif self.status == Room.VOTING:
+            snapshot['tasks'] = self.vote_list()
+        return snapshot
+
+    def winner(self):
+        return max(self.players.values(), key=lambda player: player['score'])['username']
+
+
+def change_room_state(room_id, change):
+    """
+    Applies change(state) atomically and returns the new state with the change result.
+    The change can be retried on concurrent updates, so it must not have side effects outside the state.
+    """
+    key = RoomState.key(room_id)
+
+    def apply(pipe):
+        state = RoomState.load(room_id, pipe)
+        result = change(state)
+        pipe.multi()
+        pipe.set(key, state.dumps(), ex=RoomState.TTL)
+        return state, result
+    return get_redis().transaction(apply, key, value_from_callable=True)
+
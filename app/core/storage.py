@@ -0,0 +1,23 @@
+import redis
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_connection = None
+
+
+def get_redis():
+    global _connection
+    if _connection is None:
+        _connection = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    return _connection
+
+
+@receiver(setting_changed)
+def reset_redis(setting, **kwargs):
+    """
+    Drops the connection when the tests switch the Redis settings, the next get_redis() reconnects
+    """
+    global _connection
+    if setting in ('REDIS_HOST', 'REDIS_PORT', 'REDIS_DB'):
+        _connection = None
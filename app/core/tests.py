@@ -1,5 +1,70 @@
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient, APITestCase
+
+from app.core.authentication import CachedJWTAuthentication
+from app.core.constants import SCOPE_ORDER, MAX_PLAYER_COUNT
+from app.core.consumers import LobbyConsumer, RoomConsumer
+from app.core.encoding import dumps, loads
+from app.core.event_log import EventLog, event_log
+from app.core.heartbeat import heartbeat
+from app.core.middleware import JWTAuthMiddleware
+from app.core.leaderboard import leaderboard, ALL_TIME, WEEK
+from app.core.lobby import lobby
+from app.core.mail import mail_queue, CONFIRMATION, RESET_PASSWORD
+from app.core.metrics import EventStats
+from app.core.models import Room, Player, PlayerTask, Task, Color, Pack, ROOM_COLORS_PREFIX, ArchivedRoom, \
+    ArchivedPlayer, ArchivedAnswer
+from app.core.pool import task_pool
+from app.core.protocol import Outbox, RoomProtocol
+from app.core.state import RoomState, change_room_state
+from app.core.storage import get_redis
+from app.core.timers import RoomTimers, room_timers
+from app.core.user_cache import user_cache
+from app.core.utils import event_errors
+
+
+def isolated_redis():
+    """
+    Redis connection for tests deleting shared keys, refuses to run outside REDIS_TEST_DB
+    """
+    connection = get_redis()
+    if connection.connection_pool.connection_kwargs['db'] != settings.REDIS_TEST_DB:
+        raise ImproperlyConfigured('Run the tests with app.core.runner.RedisTestRunner')
+    return connection
+
+
+def make_users(count, prefix='player'):
+    return [get_user_model().objects.create(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com')
+            for i in range(count)]
+
+
+def make_players(room, count, prefix='player', host=False, **fields):
+    """
+    Creates count users and their players in the room with distinct colors, the first one is the host if host
+    """
+    colors = Color.objects.all()[:count]
+    return [Player.objects.create(user=user, username=user.username, room=room, color=color,
+                                  host=host and i == 0, **fields)
+            for i, (user, color) in enumerate(zip(make_users(len(colors), prefix), colors))]
 
 
 class WebsocketTests(APITestCase):
@@ -45,3 +110,880 @@ class WebsocketTests(APITestCase):
         self.token2 = self.login(self.client2, self.USERNAME2, self.PASSWORD2)
         password = self.create_room(self.client)
         self.connect_room(self.client2, password)
+
+
+class RoomStateTests(SimpleTestCase):
+    def setUp(self):
+        self.state = RoomState(1, 'TestRoom', None, Room.PENDING, False, 1, 1,
+                               players={1: {'username': 'first', 'channel': 'a', 'active': True, 'host': True,
+                                            'score': 0},
+                                        2: {'username': 'second', 'channel': 'b', 'active': True, 'host': False,
+                                            'score': 0}})
+        self.state.assign({1: [[10, 'Ten'], [11, 'Eleven']], 2: [[11, 'Eleven'], [10, 'Ten']]}, SCOPE_ORDER)
+
+    def answered_round(self, scope_cost):
+        """
+        Adds a third player and answers a round of one task per player, the votes are left to the test
+        """
+        self.state.players[3] = {'username': 'third', 'channel': 'c', 'active': True, 'host': False, 'score': 0}
+        self.state.status = Room.WORKING
+        self.state.assign({1: [[10, 'Ten']], 2: [[11, 'Eleven']], 3: [[12, 'Twelve']]}, scope_cost)
+        self.state.answer(1, [(10, 'a')])
+        self.state.answer(2, [(11, 'b')])
+        self.state.answer(3, [(12, 'c')])
+
+    def test_round(self):
+        self.assertEqual(self.state.answer(1, [(10, 'a'), (11, 'b'), (12, 'c')]), ([(10, 'a'), (11, 'b')], False))
+        self.assertEqual(self.state.answer(1, [(10, 'again')]), ([], False))
+        self.assertEqual(self.state.responding_players(), [1])
+        self.assertEqual(self.state.answer(2, [(10, 'd'), (11, 'e')]), ([(10, 'd'), (11, 'e')], True))
+        self.assertEqual(self.state.status, Room.VOTING)
+        self.assertEqual(self.state.vote(1, [(10, 2)]), ([[10, 2]], False))
+        self.assertEqual(self.state.vote(2, [(10, 2)]), ([], True))
+        self.assertEqual(self.state.status, Room.FINISHED)
+        self.assertEqual(self.state.winner(), 'second')
+
+    def test_scoreboard(self):
+        self.state.current_round = 2
+        self.answered_round(2 * 2 * SCOPE_ORDER)
+        self.state.vote(1, [(11, 2)])
+        self.state.vote(2, [(10, 1)])
+        self.state.vote(3, [(11, 2)])
+        self.assertEqual(self.state.round_scores, {1: 2 * SCOPE_ORDER, 2: 4 * SCOPE_ORDER, 3: 0})
+        self.assertEqual([(item['rank'], item['username'], item['score']) for item in self.state.scores()],
+                         [(1, 'second', 4 * SCOPE_ORDER), (2, 'first', 2 * SCOPE_ORDER), (3, 'third', 0)])
+        self.assertEqual(self.state.winner(), 'second')
+        self.state.players[1]['score'] = 4 * SCOPE_ORDER
+        self.assertEqual([item['rank'] for item in self.state.scores()], [1, 1, 3])
+
+    def test_duplicate_and_self_votes(self):
+        self.answered_round(2 * SCOPE_ORDER)
+        self.assertEqual(self.state.vote(1, [(11, 2)] * 5), ([[11, 2]], False))
+        self.assertEqual(self.state.vote(2, [(11, 2), (10, 1)]), ([[10, 1]], False))
+        self.state.vote(3, [])
+        self.assertEqual(self.state.round_scores, {1: SCOPE_ORDER, 2: SCOPE_ORDER, 3: 0})
+
+    def test_unassign(self):
+        tasks = self.state.tasks
+        self.assertFalse(self.state.unassign({1: [[12, 'Twelve']]}, Room.PENDING))
+        self.assertTrue(self.state.unassign(tasks, Room.PENDING))
+        self.assertEqual((self.state.status, self.state.tasks, self.state.pending), (Room.PENDING, {}, 0))
+        self.assertTrue(self.state.assign(tasks, SCOPE_ORDER))
+
+    def test_inactive_player_does_not_hold_voting(self):
+        self.answered_round(2 * SCOPE_ORDER)
+        self.state.leave(3)
+        self.assertEqual(self.state.vote(1, [(11, 2)]), ([[11, 2]], False))
+        self.assertEqual(self.state.vote(2, [(10, 1)]), ([[10, 1]], True))
+        self.assertEqual(self.state.status, Room.FINISHED)
+
+    def test_dumps(self):
+        self.state.answer(1, [(10, 'a')])
+        loaded = RoomState.loads(self.state.dumps())
+        self.assertEqual(loaded.__dict__, self.state.__dict__)
+
+
+class PlayerTaskWriteTests(TestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        room = Room.objects.create(name='TestRoom')
+        self.room_id = room.id
+        self.players = [player.id for player in make_players(room, 3)]
+        self.tasks = [Task.objects.create(title=f'Task {i}').id for i in range(6)]
+        PlayerTask.objects.create_round({player_id: [[self.tasks[i * 2], ''], [self.tasks[i * 2 + 1], '']]
+                                         for i, player_id in enumerate(self.players)}, 1, SCOPE_ORDER)
+
+    def test_answers_in_one_query(self):
+        with self.assertNumQueries(1):
+            PlayerTask.objects.set_answers(self.players[0], 1, [(self.tasks[0], 'first'), (self.tasks[1], 'second')])
+        self.assertEqual(list(PlayerTask.objects.filter(player_id=self.players[0]).order_by('task_id')
+                                                .values_list('answer', 'status')),
+                         [('first', PlayerTask.COMPLETED), ('second', PlayerTask.COMPLETED)])
+
+    def test_scores_in_one_query(self):
+        with self.assertNumQueries(1):
+            Player.objects.update_scores({self.players[0]: 30, self.players[1]: 10, self.players[2]: 0})
+        self.assertEqual(list(Player.objects.filter(id__in=self.players).order_by('id')
+                                            .values_list('score', flat=True)),
+                         [30, 10, 0])
+
+    def test_likes_in_two_queries(self):
+        votes = [[self.tasks[2], self.players[1]], [self.tasks[4], self.players[2]], [self.tasks[5], self.players[2]]]
+        with self.assertNumQueries(2):
+            PlayerTask.objects.add_likes(self.players[0], self.room_id, 1, votes)
+        PlayerTask.objects.add_likes(self.players[0], self.room_id, 1, votes)
+        self.assertEqual(PlayerTask.likes.through.objects.filter(player_id=self.players[0]).count(), 3)
+
+
+class HotQueryIndexTests(TestCase):
+    """
+    Plans the hot queries on tables big enough for the planner to prefer an index and checks it picks the index
+    added for the query, so a query shape drifting away from its index fails
+    """
+    fixtures = ['main.json']
+    ROOMS = 1000
+    OPEN_ROOMS = 10
+    USERS = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        get_user_model().objects.bulk_create(get_user_model()(username=f'indexed{i}', email=f'indexed{i}@example.com')
+                                             for i in range(cls.USERS))
+        Room.objects.bulk_create(Room(name=f'IndexedRoom{i}', status=Room.PENDING if i < cls.OPEN_ROOMS else
+                                      Room.FINISHED) for i in range(cls.ROOMS))
+        Task.objects.bulk_create(Task(title=f'Indexed task {i}') for i in range(100))
+        users = list(get_user_model().objects.filter(username__startswith='indexed').values_list('id', flat=True))
+        rooms = list(Room.objects.filter(name__startswith='IndexedRoom').values_list('id', 'status'))
+        tasks = list(Task.objects.filter(title__startswith='Indexed task').values_list('id', flat=True))
+        colors = Color.objects.palette()
+        Player.objects.bulk_create(Player(user_id=users[(i + j) % cls.USERS], room_id=room_id, username='indexed',
+                                          color_id=colors[j], active=room_status == Room.PENDING)
+                                   for i, (room_id, room_status) in enumerate(rooms) for j in range(len(colors)))
+        players = list(Player.objects.filter(username='indexed').values_list('id', flat=True))
+        PlayerTask.objects.bulk_create(PlayerTask(player_id=player_id, task_id=tasks[(i + j) % len(tasks)],
+                                                  round=i % 3 + 1, scope_cost=SCOPE_ORDER)
+                                       for i, player_id in enumerate(players) for j in range(2))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.room = Room.objects.filter(name='IndexedRoom0').get()
+        cls.player = Player.objects.filter(room=cls.room).first()
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_hot_queries(self):
+        playertask = self.player.playertasks.first()
+        self.assertUsesIndex(PlayerTask.objects.filter(player__room_id=self.room.id, round=1,
+                                                       status=PlayerTask.PENDING), 'playertask_round_status_idx')
+        self.assertUsesIndex(PlayerTask.objects.filter(player_id=self.player.id, task_id=playertask.task_id),
+                             'unique_player_task')
+        self.assertUsesIndex(Player.objects.filter(room_id=self.room.id, active=True), 'player_room_active_idx')
+        self.assertUsesIndex(Player.objects.filter(user_id=self.player.user_id, room_id=self.room.id),
+                             'unique_user_room')
+        self.assertUsesIndex(Room.objects.filter(status=Room.PENDING), 'room_status_idx')
+        self.assertUsesIndex(Room.objects.list_actual_rooms().filter(name='IndexedRoom0'), 'room_actual_name_idx')
+
+
+class QueryBudgetTests(TestCase):
+    fixtures = ['main.json']
+    BUDGETS = {'greeting': 3, 'start': 15, 'answer': 1, 'voteList': 10}
+
+    def setUp(self):
+        Task.objects.bulk_create(Task(title=f'Budget task {i}') for i in range(10))
+        task_pool.invalidate()
+        room = Room.objects.create(name='BudgetRoom', max_round=1)
+        self.protocols = []
+        for i, player in enumerate(make_players(room, 3, 'budget', host=True)):
+            protocol = RoomProtocol.for_room(room.id)
+            protocol.channel_name = f'budget{i}'
+            protocol.token = player.user.tokens_pair['access']
+            self.protocols.append(protocol)
+        self.room_id = room.id
+        change_room_state(room.id, lambda state: None)
+
+    def tearDown(self):
+        get_redis().delete(RoomState.key(self.room_id), task_pool.used_key(self.room_id))
+        event_log.clear(self.room_id)
+        room_timers.cancel(self.room_id)
+
+    def assertQueryBudget(self, protocol, event):
+        stats = EventStats(event['eventType'])
+        outbox = stats.counted(protocol.handle_event)(event)
+        self.assertLessEqual(stats.queries, self.BUDGETS[event['eventType']],
+                             f"{event['eventType']} ran {stats.queries} queries")
+        return outbox
+
+    def test_event_budgets(self):
+        for protocol in self.protocols:
+            self.assertQueryBudget(protocol, {'eventType': 'greeting', 'token': protocol.token})
+        outbox = self.assertQueryBudget(self.protocols[0], {'eventType': 'start'})
+        questions = {channel_name: data['questions'] for kind, channel_name, data in outbox.messages}
+        for protocol in self.protocols:
+            self.assertQueryBudget(protocol, {'eventType': 'answer', 'answer': [
+                {'questionId': question['questionId'], 'answer': 'answer'}
+                for question in questions[protocol.channel_name]]})
+        vote = RoomState.load(self.room_id).vote_list()[0]
+        for protocol in self.protocols:
+            self.assertQueryBudget(protocol, {'eventType': 'voteList', 'votes': [
+                {'questionId': vote['questionId'], 'voteId': vote['answers'][0]['userID']}]})
+        self.assertEqual(RoomState.load(self.room_id).status, Room.FINISHED)
+
+
+class MetricsViewTests(TestCase):
+    def test_internal_only(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.1').status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.client.force_login(get_user_model().objects.create(username='Staff', email='staff@example.com',
+                                                                is_staff=True))
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.1').status_code, status.HTTP_200_OK)
+
+
+class ReconnectTests(TestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        Task.objects.bulk_create(Task(title=f'Reconnect task {i}') for i in range(10))
+        task_pool.invalidate()
+        room = Room.objects.create(name='ReconnectRoom', max_round=1)
+        self.players = make_players(room, 3, 'reconnect', host=True)
+        self.protocols = []
+        for i in range(3):
+            protocol = RoomProtocol.for_room(room.id)
+            protocol.channel_name = f'reconnect{i}'
+            self.protocols.append(protocol)
+        self.room_id = room.id
+
+    def tearDown(self):
+        get_redis().delete(RoomState.key(self.room_id), task_pool.used_key(self.room_id))
+        event_log.clear(self.room_id)
+        room_timers.cancel(self.room_id)
+
+    def join(self, i, version=None):
+        outbox = Outbox()
+        self.protocols[i].join(outbox, self.players[i], version)
+        return outbox
+
+    def test_replay_missed_events(self):
+        for i in range(3):
+            self.join(i)
+        version = event_log.version(self.room_id)
+        self.protocols[0].handle_event({'eventType': 'start'})
+        self.protocols[1].handle_event({'eventType': 'pause'})
+        outbox = self.join(2, version)
+        events = [data for kind, channel_name, data in outbox.messages]
+        self.assertEqual([event['eventType'] for event in events], ['define', 'questionList', 'pause'])
+        self.assertEqual(events[1]['questions'], RoomState.load(self.room_id).questions(self.players[2].id))
+        self.assertIn(events[1]['version'], range(version + 1, version + 4))
+        self.assertEqual(events[2]['version'], version + 4)
+        self.assertEqual(outbox.logged, [])
+
+    def test_snapshot_when_too_far_behind(self):
+        for i in range(3):
+            self.join(i)
+        self.protocols[0].handle_event({'eventType': 'start'})
+        log = EventLog()
+        log.SIZE = 2
+        log.append(self.room_id, [(None, {'eventType': 'pause'}), (None, {'eventType': 'resume'})])
+        kind, channel_name, snapshot = self.join(1, 1).messages[1]
+        self.assertEqual(snapshot['eventType'], 'snapshot')
+        self.assertEqual(snapshot['version'], event_log.version(self.room_id))
+        self.assertEqual(snapshot['status'], Room.ANSWERING)
+        self.assertEqual(snapshot['questions'], RoomState.load(self.room_id).questions(self.players[1].id))
+
+    def test_reconnect_is_not_broadcast(self):
+        self.assertEqual([kind for kind, channel_name, data in self.join(0).messages], [Outbox.REPLY, Outbox.REPLY])
+        self.assertEqual([kind for kind, channel_name, data in self.join(0).messages], [Outbox.REPLY, Outbox.REPLY])
+        self.assertEqual(event_log.version(self.room_id), 0)
+
+
+class HeartbeatTests(TestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        created_at = timezone.now() - timedelta(hours=1)
+        self.room = Room.objects.create(name='HeartbeatRoom', status=Room.WORKING, start_work_at=created_at)
+        self.abandoned = Room.objects.create(name='AbandonedRoom')
+        self.new = Room.objects.create(name='NewRoom')
+        Room.objects.exclude(id=self.new.id).update(created_at=created_at)
+        self.players = make_players(self.room, 2, 'heartbeat', active=True)
+        for player in self.players:
+            heartbeat.forget(player.id)
+        heartbeat.touch(self.players[0].id)
+
+    def tearDown(self):
+        for room in (self.room, self.abandoned, self.new):
+            get_redis().delete(RoomState.key(room.id))
+            room_timers.cancel(room.id)
+        for player in self.players:
+            heartbeat.forget(player.id)
+
+    def reap(self):
+        out = StringIO()
+        call_command('reap_rooms', stdout=out)
+        return out.getvalue().strip()
+
+    def test_reap_dead_players_and_abandoned_rooms(self):
+        self.assertEqual(self.reap(), '1 rooms and 1 players reclaimed')
+        self.assertEqual(list(Player.objects.filter(room=self.room).order_by('id').values_list('active', flat=True)),
+                         [True, False])
+        self.assertFalse(RoomState.load(self.room.id).players[self.players[1].id]['active'])
+        rooms = (self.room.id, self.abandoned.id, self.new.id)
+        self.assertEqual(list(Room.objects.filter(id__in=rooms).order_by('id').values_list('status', flat=True)),
+                         [Room.WORKING, Room.FINISHED, Room.PENDING])
+        heartbeat.forget(self.players[0].id)
+        self.assertEqual(self.reap(), '1 rooms and 1 players reclaimed')
+        self.room.refresh_from_db()
+        self.assertTrue(self.room.empty)
+        self.assertEqual(self.room.status, Room.FINISHED)
+        self.assertEqual(RoomState.load(self.room.id).status, Room.FINISHED)
+
+    def test_reaped_player_rejoins_on_is_alive(self):
+        self.reap()
+        protocol = RoomProtocol.for_room(self.room.id)
+        protocol.channel_name = 'heartbeat1'
+        protocol.player_id = self.players[1].id
+        outbox = protocol.handle_event({'eventType': 'isAlive', 'timestamp': 0})
+        self.assertEqual([data['eventType'] for kind, channel_name, data in outbox.messages], ['define'])
+        self.assertTrue(Player.objects.get(id=self.players[1].id).active)
+        self.assertEqual(protocol.handle_event({'eventType': 'isAlive', 'timestamp': 0}).messages, [])
+
+    def test_any_event_keeps_player_alive(self):
+        protocol = RoomProtocol.for_room(self.room.id)
+        protocol.player_id = self.players[1].id
+        protocol.handle_event({'eventType': 'answer', 'answer': []})
+        self.assertEqual(self.reap(), '1 rooms and 0 players reclaimed')
+        self.assertTrue(Player.objects.get(id=self.players[1].id).active)
+
+
+class FanOutTests(SimpleTestCase):
+    def setUp(self):
+        self.state = RoomState(1, 'TestRoom', None, Room.ANSWERING, False, 1, 1, players={
+            player_id: {'username': f'player{player_id}', 'channel': f'channel{player_id}', 'active': player_id != 3,
+                        'host': player_id == 1, 'score': 0} for player_id in (1, 2, 3)})
+        self.protocol = RoomProtocol()
+
+    def test_deliveries(self):
+        outbox = Outbox()
+        shared, own = {'eventType': 'shared'}, {'eventType': 'own'}
+        outbox.send({1: 'channel1', 2: 'channel2'}, shared)
+        outbox.send({3: 'channel3'}, own)
+        outbox.broadcast(shared)
+        self.assertEqual(outbox.deliveries(), [
+            (Outbox.DIRECT, [('channel1', dumps(shared)), ('channel2', dumps(shared)), ('channel3', dumps(own))]),
+            (Outbox.GROUP, dumps(shared))])
+        self.assertEqual(outbox.logged, [([1, 2], shared), ([3], own), (None, shared)])
+
+    def test_identical_payload_to_connected_players_is_broadcast(self):
+        outbox = Outbox()
+        self.protocol.fan_out(outbox, self.state, [1, 2], {'eventType': 'answerAccepted'})
+        self.assertEqual([kind for kind, channel_name, data in outbox.messages], [Outbox.GROUP])
+        outbox = Outbox()
+        self.protocol.fan_out(outbox, self.state, [1, 3], {'eventType': 'answerAccepted'})
+        self.assertEqual([(kind, channel_name) for kind, channel_name, data in outbox.messages],
+                         [(Outbox.DIRECT, 'channel1'), (Outbox.DIRECT, 'channel3')])
+
+
+class TaskPoolTests(TestCase):
+    def setUp(self):
+        self.pack = Pack.objects.create(title='Pool pack')
+        other = Pack.objects.create(title='Other pack')
+        Task.objects.bulk_create([Task(title=f'Pool task {i}', pack=self.pack) for i in range(6)] +
+                                 [Task(title=f'Other task {i}', pack=other) for i in range(20)])
+        self.room = Room.objects.create(name='PoolRoom')
+        self.room.packs.add(self.pack)
+        self.tearDown()
+
+    def tearDown(self):
+        get_redis().delete(task_pool.used_key(self.room.id))
+        task_pool.invalidate([self.pack.id])
+
+    def test_draws_each_task_once(self):
+        pack_tasks = set(self.pack.tasks.values_list('id', flat=True))
+        self.assertEqual(task_pool.available(self.room.id, [self.pack.id]), 6)
+        drawn = set()
+        for _ in range(3):
+            with self.assertNumQueries(1):
+                tasks = task_pool.sample(self.room.id, [self.pack.id], 2)
+            task_pool.mark_used(self.room.id, [self.pack.id], [position for task_id, title, position in tasks])
+            drawn.update(task_id for task_id, title, position in tasks)
+        self.assertEqual(drawn, pack_tasks)
+        self.assertEqual(task_pool.available(self.room.id, [self.pack.id]), 0)
+        self.assertEqual(task_pool.sample(self.room.id, [self.pack.id], 2), [])
+        self.assertEqual(get_redis().strlen(task_pool.used_key(self.room.id)), 5)
+
+    def test_rebuilt_pool_rebuilds_bitmap(self):
+        task_id, title, position = task_pool.sample(self.room.id, [self.pack.id], 1)[0]
+        Player.objects.create(user=get_user_model().objects.create(username='pool', email='pool@example.com'),
+                              username='pool', room=self.room, color=Color.objects.create(name='0000ff')) \
+                      .playertasks.create(task_id=task_id, round=1, scope_cost=SCOPE_ORDER)
+        task_pool.mark_used(self.room.id, [self.pack.id], [position])
+        Task.objects.filter(pack=self.pack).exclude(id=task_id).order_by('id').first().delete()
+        task_pool.invalidate([self.pack.id])
+        self.assertEqual(task_pool.available(self.room.id, [self.pack.id]), 4)
+        self.assertNotIn(task_id, [task[0] for task in task_pool.sample(self.room.id, [self.pack.id], 4)])
+
+    def test_deleted_task_redraws(self):
+        self.assertEqual(task_pool.available(self.room.id, [self.pack.id]), 6)
+        self.pack.tasks.order_by('id').first().delete()
+        tasks = task_pool.sample(self.room.id, [self.pack.id], 6)
+        self.assertEqual(sorted(task_id for task_id, title, position in tasks),
+                         sorted(self.pack.tasks.values_list('id', flat=True)))
+        self.assertEqual(task_pool.available(self.room.id, [self.pack.id]), 5)
+
+
+class ImportTasksTests(TestCase):
+    def test_invalid_rows_are_skipped(self):
+        Task.objects.create(title='Existing task')
+        lines = ['{"title": "First task", "pack": "Imported"}', 'not json', '["title"]', '{"title": 5}',
+                 '{"title": "Existing task"}', '{"title": "Second task"}']
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            file.write('\n'.join(lines))
+        self.addCleanup(os.remove, file.name)
+        out = StringIO()
+        call_command('import_tasks', file.name, stdout=out)
+        self.assertIn('3 rows submitted', out.getvalue())
+        self.assertIn('2 tasks created (existing titles kept), 3 invalid rows skipped', out.getvalue())
+        self.assertEqual(Task.objects.get(title='First task').pack.title, 'Imported')
+
+
+class UserCacheTests(TestCase):
+    def test_cached_until_auth_fields_change(self):
+        user = get_user_model().objects.create_user('CachedUser', 'cached@example.com', 'TestPassword')
+        authentication = CachedJWTAuthentication()
+        token = authentication.get_validated_token(user.tokens_pair['access'])
+        with self.assertNumQueries(1):
+            authentication.get_user(token)
+        with self.assertNumQueries(0):
+            self.assertEqual(authentication.get_user(token), user)
+        user.login_fill()
+        with self.assertNumQueries(0):
+            authentication.get_user(token)
+        user.is_active = False
+        user.save(update_fields=('is_active',))
+        with self.assertRaises(AuthenticationFailed):
+            authentication.get_user(token)
+
+    def test_password_not_cached(self):
+        user = get_user_model().objects.create_user('CachedUser', 'cached@example.com', 'TestPassword')
+        authentication = CachedJWTAuthentication()
+        token = authentication.get_validated_token(user.tokens_pair['access'])
+        authentication.get_user(token)
+        self.assertNotIn(user.password.encode(), get_redis().hget(user_cache.key(user.id), token['jti']))
+        with self.assertNumQueries(0):
+            cached = authentication.get_user(token)
+            self.assertEqual((cached.username, cached.is_active, cached.is_staff), (user.username, True, False))
+        self.assertIn('password', cached.get_deferred_fields())
+
+
+class SocketAuthTests(TransactionTestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        user = get_user_model().objects.create(username='SocketUser', email='socket@example.com')
+        room = Room.objects.create(name='SocketRoom')
+        Player.objects.create(user=user, username=user.username, room=room, color=Color.objects.first(), host=True)
+        self.token = user.tokens_pair['access']
+        self.room_id = room.id
+
+    def tearDown(self):
+        get_redis().delete(RoomState.key(self.room_id))
+
+    def test_handshake(self):
+        async_to_sync(self.handshake)()
+
+    async def handshake(self):
+        application = JWTAuthMiddleware(RoomConsumer)
+        for path in ('/game/SocketRoom/', '/game/SocketRoom/?token=invalid', f'/game/OtherRoom/?token={self.token}'):
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope['url_route'] = {'kwargs': {'room_name': path.split('/')[2]}}
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+        communicator = WebsocketCommunicator(application, '/game/SocketRoom/', subprotocols=['Bearer', self.token])
+        communicator.scope['url_route'] = {'kwargs': {'room_name': 'SocketRoom'}}
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, 'Bearer'))
+        self.assertEqual((await communicator.receive_json_from())['eventType'], 'connection')
+        self.assertEqual((await communicator.receive_json_from())['eventType'], 'define')
+        await communicator.disconnect()
+        lobby_application = JWTAuthMiddleware(LobbyConsumer)
+        for path, connects in (('/lobby/', False), ('/lobby/?token=invalid', False),
+                               (f'/lobby/?token={self.token}', True)):
+            communicator = WebsocketCommunicator(lobby_application, path)
+            communicator.scope['url_route'] = {'kwargs': {}}
+            connected, _ = await communicator.connect()
+            self.assertEqual(connected, connects)
+            if connected:
+                await communicator.disconnect()
+
+
+    def test_idle_socket_stays_alive(self):
+        async_to_sync(self.idle)()
+
+    async def idle(self):
+        communicator = WebsocketCommunicator(JWTAuthMiddleware(FastPingRoomConsumer),
+                                             f'/game/SocketRoom/?token={self.token}')
+        communicator.scope['url_route'] = {'kwargs': {'room_name': 'SocketRoom'}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        player_id = await sync_to_async(Player.objects.values_list('id', flat=True).get)(room_id=self.room_id)
+        heartbeat.forget(player_id)
+        self.assertEqual((await communicator.receive_json_from())['eventType'], 'isAlive')
+        await sync_to_async(call_command)('reap_rooms', stdout=StringIO())
+        self.assertTrue(await sync_to_async(Player.objects.values_list('active', flat=True).get)(id=player_id))
+        await communicator.disconnect()
+
+
+class FastPingRoomConsumer(RoomConsumer):
+    heartbeat_interval = 0.1
+
+
+class ColorAllocationTests(TransactionTestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        self.room = Room.objects.create(name='ColorRoom')
+        get_redis().delete(f'{ROOM_COLORS_PREFIX}{self.room.id}', f'{ROOM_COLORS_PREFIX}{self.room.id}:seeded')
+
+    def join(self, user):
+        try:
+            player, _ = Player.objects.join(user, self.room.id, '')
+            return player.color_id
+        finally:
+            connection.close()
+
+    def test_concurrent_joins_get_distinct_colors(self):
+        users = make_users(len(Color.objects.palette()), 'ColorUser')
+        Player.objects.create_player(users[0], self.room, '', host=True)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            colors = list(executor.map(self.join, users[1:]))
+        colors.append(Player.objects.get(user=users[0]).color_id)
+        self.assertEqual(sorted(colors), sorted(Color.objects.palette()))
+        self.assertEqual(sorted(Player.objects.filter(room=self.room).values_list('color_id', flat=True)),
+                         sorted(Color.objects.palette()))
+
+    def test_failed_join_returns_color(self):
+        user, = make_users(1, 'ColorUser')
+        Player.objects.create_player(user, self.room, '')
+        free_key = f'{ROOM_COLORS_PREFIX}{self.room.id}'
+        free = get_redis().smembers(free_key)
+        with self.assertRaises(IntegrityError):
+            Player.objects.create_player(user, self.room, '')
+        self.assertEqual(get_redis().smembers(free_key), free)
+
+
+class ConcurrentJoinTests(TransactionTestCase):
+    fixtures = ['main.json']
+    JOINS = 200
+
+    def setUp(self):
+        get_user_model().objects.bulk_create(get_user_model()(username=f'joiner{i}', email=f'joiner{i}@example.com')
+                                             for i in range(self.JOINS + 1))
+        self.users = list(get_user_model().objects.filter(username__startswith='joiner'))
+        self.room = Room.objects.create(name='CrowdedRoom', private=False)
+        Player.objects.create_player(self.users[0], self.room, '', host=True)
+
+    def join(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            return client.post('/room/connect/', {'username': '', 'name': 'CrowdedRoom'}, format='json').status_code
+        finally:
+            connection.close()
+
+    def test_capacity_under_concurrent_joins(self):
+        with ThreadPoolExecutor(max_workers=50) as executor:
+            codes = list(executor.map(self.join, self.users[1:]))
+        self.assertEqual(codes.count(status.HTTP_200_OK), MAX_PLAYER_COUNT - 1)
+        self.assertEqual(codes.count(status.HTTP_400_BAD_REQUEST), self.JOINS - MAX_PLAYER_COUNT + 1)
+        self.assertEqual(Player.objects.filter(room=self.room).count(), MAX_PLAYER_COUNT)
+        self.assertEqual(self.join(self.users[0]), status.HTTP_200_OK)
+
+    def test_join_queries(self):
+        Color.objects.palette()
+        client = APIClient()
+        client.force_authenticate(self.users[1])
+        # the room, its locked row, its players, the insert and the savepoint around it
+        with self.assertNumQueries(6):
+            response = client.post('/room/connect/', {'username': '', 'name': 'CrowdedRoom'}, format='json')
+        self.assertCountEqual(response.data['players'], [self.users[0].username, self.users[1].username])
+
+
+class EventValidationTests(SimpleTestCase):
+    def test_errors(self):
+        self.assertEqual(event_errors({'eventType': 'start', 'timestamp': 1.0}), [])
+        self.assertEqual(event_errors({'eventType': 'unknown', 'timestamp': 1.0}),
+                         [{'path': 'eventType', 'message': 'Unknown event type'}])
+        for event_type in (['start'], {'start': 1}, None):
+            self.assertEqual(event_errors({'eventType': event_type, 'timestamp': 1.0}),
+                             [{'path': 'eventType', 'message': 'Unknown event type'}])
+        self.assertEqual(event_errors({'eventType': 'voteList', 'timestamp': 1.0,
+                                       'votes': [{'questionId': 1, 'voteId': 2}, {'questionId': 1}]}),
+                         [{'path': 'votes.1', 'message': "'voteId' is a required property"}])
+
+
+class StressRoomTimers(RoomTimers):
+    DUE_KEY = 'test_room_timers:due'
+    EVENTS_KEY = 'test_room_timers:events'
+    PAUSED_KEY = 'test_room_timers:paused'
+
+
+class RoomTimersTests(SimpleTestCase):
+    ROOMS = 10000
+    NOW = 1000.0
+
+    def setUp(self):
+        self.timers = StressRoomTimers()
+        self.tearDown()
+
+    def tearDown(self):
+        get_redis().delete(StressRoomTimers.DUE_KEY, StressRoomTimers.EVENTS_KEY, StressRoomTimers.PAUSED_KEY)
+
+    def test_concurrent_rooms(self):
+        for room_id in range(self.ROOMS):
+            self.timers.schedule(room_id, 'answering:1', 60 + room_id % 60, now=self.NOW)
+        for room_id in range(0, self.ROOMS, 2):
+            self.timers.cancel(room_id)
+        for room_id in range(1, self.ROOMS, 4):
+            self.assertEqual(self.timers.pause(room_id, now=self.NOW + 10), 50 + room_id % 60)
+        expired = self.timers.pop_due(limit=self.ROOMS, now=self.NOW + 200)
+        self.assertEqual(len(expired), self.ROOMS // 4)
+        self.assertTrue(all(room_id % 4 == 3 and event == 'answering:1' for room_id, event in expired))
+        self.assertEqual(self.timers.pop_due(limit=self.ROOMS, now=self.NOW + 200), [])
+        for room_id in range(1, self.ROOMS, 4):
+            self.timers.resume(room_id, now=self.NOW + 300)
+        self.assertEqual(self.timers.pop_due(limit=self.ROOMS, now=self.NOW + 349), [])
+        self.assertEqual(len(self.timers.pop_due(limit=self.ROOMS, now=self.NOW + 410)), self.ROOMS // 4)
+        self.assertEqual(get_redis().zcard(StressRoomTimers.DUE_KEY), 0)
+
+
+class LobbyTests(APITestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        redis = isolated_redis()
+        redis.delete(lobby.ROOMS_KEY, lobby.BUILT_KEY, *redis.keys(lobby.ROOM_KEY_PREFIX + '*'))
+        user = get_user_model().objects.create_user('LobbyUser', 'lobby@example.com', 'TestPassword')
+        self.client.force_authenticate(user)
+        for i in range(5):
+            room = Room.objects.create(name=f'LobbyRoom{i}', private=i % 2 == 0)
+            Player.objects.create_player(user, room, '')
+        Room.objects.create(name='FinishedRoom', status=Room.FINISHED)
+
+    def test_pages_and_etag(self):
+        response = self.client.get('/room/', {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([room['name'] for room in response.data['results']], ['LobbyRoom0', 'LobbyRoom1'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([room['name'] for room in response.data['results']], ['LobbyRoom2', 'LobbyRoom3'])
+        response = self.client.get('/room/', {'private': 'false', 'free_slots': 1})
+        self.assertEqual([(room['name'], room['player_count']) for room in response.data['results']],
+                         [('LobbyRoom1', 1), ('LobbyRoom3', 1)])
+        self.assertIsNone(response.data['next'])
+        with self.assertNumQueries(0):
+            response = self.client.get('/room/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        lobby._remove_room(Room.objects.get(name='LobbyRoom1').id)
+        response = self.client.get('/room/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(len(response.data['results']), 4)
+
+
+class LeaderboardTests(APITestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        isolated_redis().delete(leaderboard.BUILT_KEY, leaderboard.key(ALL_TIME), leaderboard.key(WEEK))
+        self.users = [get_user_model().objects.create_user(f'Leader{i}', f'leader{i}@example.com', 'TestPassword')
+                      for i in range(3)]
+        self.client.force_authenticate(self.users[0])
+
+    def play(self, name, scores, liked_by=()):
+        room = Room.objects.create(name=name, status=Room.WORKING, start_work_at=timezone.now())
+        players = [Player.objects.create(user=user, username=user.username, room=room, color=color, score=score)
+                   for user, score, color in zip(self.users, scores, Color.objects.all())]
+        playertask = PlayerTask.objects.create(player=players[0], task=Task.objects.create(title=f'{name} task'),
+                                               round=1, scope_cost=SCOPE_ORDER)
+        playertask.likes.add(*[players[i] for i in liked_by])
+        room.finish_work()
+        room.finish_work()
+
+    def test_stats_and_ranks(self):
+        self.play('FirstGame', [30, 10, 0], liked_by=(1, 2))
+        self.play('SecondGame', [0, 40, 0])
+        Room.objects.create(name='AbandonedGame').finish_work()
+        response = self.client.get('/player/leaderboard/', {'period': WEEK})
+        self.assertEqual([(item['rank'], item['username'], item['score']) for item in response.data],
+                         [(1, 'Leader1', 50), (2, 'Leader0', 30), (3, 'Leader2', 0)])
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/player/{self.users[0].id}/stats/')
+        self.assertEqual(response.data, {'games': 2, 'wins': 1, 'likes': 2, 'score': 30, 'average_score': 15.0,
+                                         'ranks': {ALL_TIME: {'rank': 2, 'score': 30},
+                                                   WEEK: {'rank': 2, 'score': 30}}})
+        self.assertEqual(self.client.get('/player/leaderboard/', {'period': 'year'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class ArchiveTests(TestCase):
+    fixtures = ['main.json']
+
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user(f'Archived{i}', f'archived{i}@example.com', 'TestPassword')
+                      for i in range(2)]
+
+    def play(self, name, finished_ago):
+        room = Room.objects.create(name=name, status=Room.WORKING, start_work_at=timezone.now())
+        players = [Player.objects.create(user=user, username=user.username, room=room, color=color, score=10 * i)
+                   for i, (user, color) in enumerate(zip(self.users, Color.objects.all()))]
+        playertask = PlayerTask.objects.create(player=players[1], task=Task.objects.create(title=f'{name} task'),
+                                               round=1, scope_cost=SCOPE_ORDER, answer='Answer')
+        playertask.likes.add(players[0])
+        room.finish_work()
+        Room.objects.filter(id=room.id).update(finish_work_at=timezone.now() - finished_ago)
+        return room
+
+    def test_archive_rooms(self):
+        old = self.play('OldGame', timedelta(days=1))
+        recent = self.play('RecentGame', timedelta())
+        connected = self.play('ConnectedGame', timedelta(days=1))
+        connected.players.filter(user=self.users[0]).update(active=True)
+        week_scores = Player.objects.scores_since(timezone.now() - timedelta(days=2))
+        call_command('archive_rooms', batch=1, stdout=StringIO())
+        self.assertEqual(list(Room.objects.filter(name__endswith='Game').order_by('id')), [recent, connected])
+        self.assertFalse(Player.objects.filter(room_id=old.id).exists())
+        self.assertFalse(PlayerTask.objects.filter(player__room_id=old.id).exists())
+        self.assertEqual(ArchivedRoom.objects.get().id, old.id)
+        self.assertEqual(list(ArchivedPlayer.objects.order_by('user_id').values_list('score', 'likes')),
+                         [(0, 0), (10, 1)])
+        self.assertEqual(list(ArchivedAnswer.objects.values_list('user_id', 'answer', 'likes')),
+                         [(self.users[1].id, 'Answer', 1)])
+        self.assertEqual(Player.objects.scores_since(timezone.now() - timedelta(days=2)), week_scores)
+
+
+class LobbyFeedTests(SimpleTestCase):
+    ROOM_ID = 900001
+
+    def setUp(self):
+        self.redis = isolated_redis()
+
+    def tearDown(self):
+        self.redis.delete(lobby.room_key(self.ROOM_ID), lobby.room_key(self.ROOM_ID + 1))
+        self.redis.zrem(lobby.ROOMS_KEY, self.ROOM_ID, self.ROOM_ID + 1)
+
+    def room(self, room_id, name):
+        return {'id': room_id, 'name': name, 'player_count': 0, 'current_round': 1, 'max_round': 3,
+                'status': Room.PENDING, 'private': False}
+
+    def test_coalesced_diffs(self):
+        async_to_sync(self.feed)()
+
+    async def feed(self):
+        communicator = WebsocketCommunicator(LobbyConsumer, '/lobby/')
+        communicator.scope['user'] = get_user_model()(username='FeedUser')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        await sync_to_async(lobby._add_room)(self.room(self.ROOM_ID, 'FeedRoom'))
+        await sync_to_async(lobby._add_player)(self.ROOM_ID)
+        await sync_to_async(lobby._add_player)(self.ROOM_ID)
+        await sync_to_async(lobby._change_room)(self.ROOM_ID, {'status': Room.WORKING})
+        await sync_to_async(lobby._add_room)(self.room(self.ROOM_ID + 1, 'GoneRoom'))
+        await sync_to_async(lobby._remove_room)(self.ROOM_ID + 1)
+        event = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(event['eventType'], 'lobby')
+        self.assertEqual(event['rooms'], [{'change': 'created', 'name': 'FeedRoom', 'player_count': 2,
+                                           'current_round': 1, 'max_round': 3, 'status': Room.WORKING,
+                                           'private': False, 'max_player_count': MAX_PLAYER_COUNT}])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        recipients = []
+        for line in iter(self.rfile.readline, b''):
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            if verb == 'RCPT':
+                address = command.split(':', 1)[1].strip(' <>')
+                if address in self.server.rejected:
+                    self.reply('550 Mailbox unavailable')
+                    continue
+                recipients.append(address)
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n')).decode()
+                self.server.messages.append((recipients, data))
+                recipients = []
+            self.reply('250 OK')
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server of the mail tests, keeps the received messages and counts connections
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.rejected = set()
+
+
+class MailTests(TestCase):
+    def setUp(self):
+        isolated_redis().delete(mail_queue.QUEUE_KEY, mail_queue.RETRY_KEY)
+        self.smtp = SMTPStandIn()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        smtp_settings = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                          EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtp.server_address[1],
+                                          EMAIL_USE_TLS=False, EMAIL_HOST_USER='bucket@example.com',
+                                          EMAIL_HOST_PASSWORD='')
+        smtp_settings.enable()
+        self.addCleanup(smtp_settings.disable)
+        self.users = [get_user_model().objects.create_user(f'Mail{i}', f'mail{i}@example.com', 'TestPassword')
+                      for i in range(3)]
+
+    def tearDown(self):
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        isolated_redis().delete(mail_queue.QUEUE_KEY, mail_queue.RETRY_KEY)
+
+    def send_emails(self):
+        out = StringIO()
+        call_command('send_emails', once=True, stdout=out)
+        return out.getvalue().strip()
+
+    def test_batch_over_one_connection(self):
+        self.assertEqual(get_redis().llen(mail_queue.QUEUE_KEY), 0)
+        for user in self.users:
+            mail_queue._enqueue(CONFIRMATION, user.id)
+        mail_queue._enqueue(RESET_PASSWORD, self.users[0].id)
+        self.assertEqual(self.send_emails(), '4 emails sent')
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual([recipients for recipients, data in self.smtp.messages],
+                         [['mail0@example.com'], ['mail1@example.com'], ['mail2@example.com'], ['mail0@example.com']])
+        self.assertIn('Subject: Friend Bucket Password Reset', self.smtp.messages[-1][1])
+
+    def test_retry_with_backoff(self):
+        self.smtp.rejected.add('mail1@example.com')
+        for user in self.users[:2]:
+            mail_queue._enqueue(CONFIRMATION, user.id)
+        with self.assertLogs('app.core.mail', 'ERROR'):
+            self.assertEqual(self.send_emails(), '1 emails sent')
+        (job, due), = get_redis().zrange(mail_queue.RETRY_KEY, 0, -1, withscores=True)
+        self.assertAlmostEqual(due, time.time() + mail_queue.BACKOFF, delta=5)
+        self.smtp.rejected.clear()
+        self.assertEqual([job['attempt'] for job in mail_queue.pop(10, now=due)], [1])
+        self.assertFalse(mail_queue.retry({'kind': CONFIRMATION, 'user_id': self.users[1].id,
+                                           'attempt': mail_queue.MAX_ATTEMPTS - 1}))
+
+    def test_failed_build_is_retried(self):
+        mail_queue._enqueue(CONFIRMATION, self.users[0].id)
+        mail_queue._enqueue('unknown', self.users[1].id)
+        mail_queue._enqueue(CONFIRMATION, self.users[2].id)
+        with self.assertLogs('app.core.mail', 'ERROR'):
+            self.assertEqual(self.send_emails(), '2 emails sent')
+        self.assertEqual([recipients for recipients, data in self.smtp.messages],
+                         [['mail0@example.com'], ['mail2@example.com']])
+        (job, due), = isolated_redis().zrange(mail_queue.RETRY_KEY, 0, -1, withscores=True)
+        self.assertEqual(loads(job), {'kind': 'unknown', 'user_id': self.users[1].id, 'attempt': 1})
+
+
+class RedisIsolationTests(SimpleTestCase):
+    def test_test_database(self):
+        self.assertEqual(isolated_redis().connection_pool.connection_kwargs['db'], settings.REDIS_TEST_DB)
+        for layer in settings.CHANNEL_LAYERS.values():
+            for host in layer.get('CONFIG', {}).get('hosts', []):
+                self.assertEqual(host['db'], settings.REDIS_TEST_DB)
@@ -0,0 +1,108 @@
+from time import time
+
+from app.core.storage import get_redis
+
+POP_DUE_SCRIPT = """
+local room_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local expired = {}
+for _, room_id in ipairs(room_ids) do
+    redis.call('ZREM', KEYS[1], room_id)
+    local event = redis.call('HGET', KEYS[2], room_id)
+    redis.call('HDEL', KEYS[2], room_id)
+    if event then
+        table.insert(expired, room_id)
+        table.insert(expired, event)
+    end
+end
+return expired
+"""
+
+PAUSE_SCRIPT = """
+local due = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not due then
+    return false
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+local remaining = tostring(math.max(tonumber(due) - tonumber(ARGV[2]), 0))
+redis.call('HSET', KEYS[2], ARGV[1], remaining)
+return remaining
+"""
+
+RESUME_SCRIPT = """
+local remaining = redis.call('HGET', KEYS[2], ARGV[1])
+if not remaining then
+    return false
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[1], tonumber(ARGV[2]) + tonumber(remaining), ARGV[1])
+return remaining
+"""
+
+
+class RoomTimers:
+    """
+    Phase timers, one per room, kept in a Redis sorted set scored by due time.
+    Cancel is a ZREM, pause moves the remaining time aside and resume puts the timer back.
+    """
+    DUE_KEY = 'room_timers:due'
+    EVENTS_KEY = 'room_timers:events'
+    PAUSED_KEY = 'room_timers:paused'
+
+    def __init__(self, connection=None):
+        self._connection = connection
+        self._scripts = {}
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def script(self, source):
+        if source not in self._scripts:
+            self._scripts[source] = self.connection.register_script(source)
+        return self._scripts[source]
+
+    def schedule(self, room_id, event, delay, now=None):
+        pipe = self.connection.pipeline()
+        pipe.zadd(self.DUE_KEY, {room_id: (now or time()) + delay})
+        pipe.hset(self.EVENTS_KEY, room_id, event)
+        pipe.hdel(self.PAUSED_KEY, room_id)
+        pipe.execute()
+
+    def cancel(self, room_id):
+        pipe = self.connection.pipeline()
+        pipe.zrem(self.DUE_KEY, room_id)
+        pipe.hdel(self.EVENTS_KEY, room_id)
+        pipe.hdel(self.PAUSED_KEY, room_id)
+        pipe.execute()
+
+    def pause(self, room_id, now=None):
+        """
+        Returns remaining seconds of the paused timer or None if the room has no running timer
+        """
+        remaining = self.script(PAUSE_SCRIPT)(keys=[self.DUE_KEY, self.PAUSED_KEY], args=[room_id, now or time()])
+        return float(remaining) if remaining is not None else None
+
+    def resume(self, room_id, now=None):
+        """
+        Returns remaining seconds of the resumed timer or None if the room has no paused timer
+        """
+        remaining = self.script(RESUME_SCRIPT)(keys=[self.DUE_KEY, self.PAUSED_KEY], args=[room_id, now or time()])
+        return float(remaining) if remaining is not None else None
+
+    def remaining(self, room_id, now=None):
+        due = self.connection.zscore(self.DUE_KEY, room_id)
+        if due is not None:
+            return max(due - (now or time()), 0)
+        remaining = self.connection.hget(self.PAUSED_KEY, room_id)
+        return float(remaining) if remaining is not None else None
+
+    def pop_due(self, limit=100, now=None):
+        """
+        Claims up to limit expired timers and returns their (room id, event) pairs.
+        Claiming is atomic, so several dispatchers can run at once.
+        """
+        expired = self.script(POP_DUE_SCRIPT)(keys=[self.DUE_KEY, self.EVENTS_KEY], args=[now or time(), limit])
+        return [(int(expired[i]), expired[i + 1].decode()) for i in range(0, len(expired), 2)]
+
+
+room_timers = RoomTimers()
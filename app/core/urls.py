@@ -5,7 +5,7 @@ from rest_framework import routers
 from rest_framework_simplejwt.views import TokenRefreshView
 from rest_framework.schemas import get_schema_view
 
-from app.core.views import AuthorizationViewSet, PlayerViewSet, RoomViewSet
+from app.core.views import AuthorizationViewSet, PlayerViewSet, RoomViewSet, PackViewSet, metrics
 
 
 urlpatterns = [
@@ -17,11 +17,13 @@ urlpatterns = [
                                 version='1.0.0',
                                 public=True
                             ), name='swagger'),
-    path('admin/', admin.site.urls)
+    path('admin/', admin.site.urls),
+    path('metrics/', metrics, name='metrics'),
 ]
 
 router = routers.SimpleRouter()
 router.register(r'auth', AuthorizationViewSet, basename='auth')
 router.register(r'player', PlayerViewSet, basename='player')
 router.register(r'room', RoomViewSet, basename='room')
+router.register(r'pack', PackViewSet, basename='pack')
 urlpatterns += router.urls
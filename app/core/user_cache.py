@@ -0,0 +1,47 @@
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+
+from app.core.encoding import dumps, loads
+from app.core.storage import get_redis
+
+
+class UserCache:
+    """
+    Authenticated users in Redis, a hash per user id with the auth fields of the user per token jti.
+    Cached users are rebuilt with the other fields deferred, the password hash never leaves the database.
+    The hash is dropped when the password or a cached field of the user changes.
+    """
+    KEY_PREFIX = 'auth_user:'
+    TTL = 60
+    FIELDS = ('id', 'username', 'email', 'is_active', 'is_staff', 'is_superuser', 'is_confirmed')
+
+    def __init__(self, connection=None):
+        self._connection = connection
+
+    @property
+    def connection(self):
+        return self._connection or get_redis()
+
+    def key(self, user_id):
+        return f'{self.KEY_PREFIX}{user_id}'
+
+    def get(self, user_id, jti):
+        data = self.connection.hget(self.key(user_id), jti)
+        if data is None:
+            return None
+        data = loads(data)
+        model = get_user_model()
+        fields = [field.attname for field in model._meta.concrete_fields if field.attname in data]
+        return model.from_db(DEFAULT_DB_ALIAS, fields, [data[field] for field in fields])
+
+    def set(self, user_id, jti, user):
+        pipe = self.connection.pipeline()
+        pipe.hset(self.key(user_id), jti, dumps({field: getattr(user, field) for field in self.FIELDS}))
+        pipe.expire(self.key(user_id), self.TTL)
+        pipe.execute()
+
+    def invalidate(self, user_id):
+        self.connection.delete(self.key(user_id))
+
+
+user_cache = UserCache()
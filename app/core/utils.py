@@ -1,23 +1,29 @@
+import logging
 from random import sample
 from string import ascii_uppercase, digits
+from time import time
 
-import jsonschema
-from django.utils import timezone
-from jsonschema import validate
+from jsonschema import Draft7Validator
 
 from app.core.constants import PASSWORD_CHARS_NUMBER, ANSWERING_DURATION
 from app.core.schemas import EVENTS_SCHEMAS
 
+logger = logging.getLogger(__name__)
+
+EVENT_TYPE_FIELD = 'eventType'
+EVENT_VALIDATORS = {schema['properties'][EVENT_TYPE_FIELD]['const']: Draft7Validator(schema)
+                    for schema in EVENTS_SCHEMAS}
+
 
 def generate_password():
     return ''.join(sample(ascii_uppercase + digits, PASSWORD_CHARS_NUMBER))
 
 
 def event_wrapper(event_type, **kwargs):
-    data = {'eventType': event_type, 'timestamp': timezone.now().timestamp()}
-    data.update(kwargs)
-    print(data)
-    return data
+    kwargs['eventType'] = event_type
+    kwargs['timestamp'] = time()
+    logger.debug('Outgoing event %s', kwargs)
+    return kwargs
 
 
 def connection_event():
@@ -28,11 +34,13 @@ def greeting_event(name, password, users):
     return event_wrapper('greeting', name=name, password=password, users=users)
 
 
-def start_event(questions):
-    return event_wrapper('questionList', questions=questions, timeForAnswer=ANSWERING_DURATION)
+def start_event(questions, time_for_answer=ANSWERING_DURATION):
+    return event_wrapper('questionList', questions=questions, timeForAnswer=time_for_answer)
 
 
-def error_event(message):
+def error_event(message, errors=None):
+    if errors:
+        return event_wrapper('error', message=message, errors=errors)
     return event_wrapper('error', message=message)
 
 
@@ -52,8 +60,8 @@ def vote_event(tasks):
     return event_wrapper('voteList', tasks=tasks, )
 
 
-def winner_event(username):
-    return event_wrapper('winner', username=username)
+def winner_event(username, scores=None):
+    return event_wrapper('winner', username=username, scores=scores)
 
 
 def reconnect_event(event):
@@ -72,16 +80,30 @@ def resume_event():
     return event_wrapper('resume')
 
 
-def validate_schema(data, schema):
-    try:
-        validate(data, schema)
-    except jsonschema.exceptions.ValidationError:
-        return False
-    return True
+def snapshot_event(version, room, time_left=None):
+    return event_wrapper('snapshot', version=version, timeLeft=time_left, **room)
+
+
+def lobby_event(rooms, version):
+    return event_wrapper('lobby', rooms=rooms, version=version)
+
+
+def event_errors(event):
+    """
+    Validates an event against the schema of its type only, returns a list of {'path', 'message'} errors
+    """
+    if not isinstance(event, dict):
+        return [{'path': '', 'message': 'Event must be an object'}]
+    event_type = event.get(EVENT_TYPE_FIELD)
+    validator = EVENT_VALIDATORS.get(event_type) if isinstance(event_type, str) else None
+    if validator is None:
+        return [{'path': EVENT_TYPE_FIELD, 'message': 'Unknown event type'}]
+    return [{'path': '.'.join(str(part) for part in error.absolute_path), 'message': error.message}
+            for error in validator.iter_errors(event)]
 
 
 def validate_event(event):
-    return any([validate_schema(event, schema) for schema in EVENTS_SCHEMAS])
+    return not event_errors(event)
 
 
 def group_by(items, group_name, *args):
@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db.models import Count
+from django.http import HttpResponse, HttpResponseForbidden
 from rest_framework import serializers
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, CreateModelMixin
@@ -7,11 +9,15 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.utils.urls import replace_query_param
 
-from app.core.models import Room
+from app.core.leaderboard import leaderboard, week_start, PERIODS, ALL_TIME
+from app.core.lobby import lobby
+from app.core.metrics import exposition
+from app.core.models import Room, Pack, Player, UserStats
 from app.core.serializers import SigUpSerializer, LogInSerializer, ConnectRoomSerializer, RoomSerializer, \
     CreateRoomSerializer, MeSerializer, ConfirmEmailSerializer, ResendConfirmEmailSerializer, ResetPasswordSerializer, \
-    SendRestorePasswordSerializer
+    SendRestorePasswordSerializer, PackSerializer, UserStatsSerializer
 
 
 class AuthorizationViewSet(GenericViewSet):
@@ -97,12 +103,26 @@ class AuthorizationViewSet(GenericViewSet):
 class PlayerViewSet(GenericViewSet, RetrieveModelMixin):
     queryset = get_user_model().objects.all()
     permission_classes = [IsAuthenticated]
+    leaderboard_size = 10
+    max_leaderboard_size = 100
+
+    def get_queryset(self):
+        if self.action == 'stats':
+            return super().get_queryset().select_related('stats')
+        return super().get_queryset()
 
     def get_serializer_class(self):
         if self.action in ('me', 'retrieve'):
             return MeSerializer
+        if self.action == 'stats':
+            return UserStatsSerializer
         return serializers.Serializer
 
+    @staticmethod
+    def build_leaderboard():
+        if not leaderboard.is_built():
+            leaderboard.rebuild(UserStats.objects.scores(), Player.objects.scores_since(week_start()))
+
     @action(methods=['GET'], detail=False)
     def me(self, request, *args, **kwargs):
         """
@@ -111,16 +131,80 @@ class PlayerViewSet(GenericViewSet, RetrieveModelMixin):
         serializer = self.get_serializer(request.user)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(methods=['GET'], detail=False)
+    def leaderboard(self, request, *args, **kwargs):
+        """
+        Top players of all time or of the week by score
+        """
+        period = request.query_params.get('period', ALL_TIME)
+        if period not in PERIODS:
+            raise serializers.ValidationError(f'period must be one of {", ".join(PERIODS)}')
+        try:
+            limit = min(int(request.query_params.get('limit', self.leaderboard_size)), self.max_leaderboard_size)
+        except ValueError:
+            raise serializers.ValidationError('limit must be an integer')
+        self.build_leaderboard()
+        top = leaderboard.top(period, max(limit, 1))
+        usernames = dict(get_user_model().objects.filter(id__in=[user_id for user_id, _ in top])
+                                                 .values_list('id', 'username'))
+        return Response([{'rank': rank, 'id': user_id, 'username': usernames.get(user_id), 'score': score}
+                         for rank, (user_id, score) in enumerate(top, 1)], status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=True)
+    def stats(self, request, *args, **kwargs):
+        """
+        Career stats of a player with the all time and week ranks
+        """
+        user = self.get_object()
+        self.build_leaderboard()
+        try:
+            stats = user.stats
+        except UserStats.DoesNotExist:
+            stats = UserStats(user=user)
+        data = self.get_serializer(stats).data
+        data['ranks'] = {}
+        for period in PERIODS:
+            rank, score = leaderboard.rank(user.id, period)
+            data['ranks'][period] = {'rank': rank, 'score': score}
+        return Response(data, status=status.HTTP_200_OK)
+
 
 class RoomViewSet(GenericViewSet, ListModelMixin, CreateModelMixin, RetrieveModelMixin):
     queryset = Room.objects.exclude(status=Room.FINISHED)
     permission_classes = [IsAuthenticated]
+    page_size = 20
+    max_page_size = 100
 
     def get_queryset(self):
-        if self.action == 'list':
+        if self.action == 'retrieve':
             return super().get_queryset().annotate(player_count=Count('players'))
         return super().get_queryset()
 
+    def list(self, request, *args, **kwargs):
+        """
+        Lobby rooms from the Redis index, filtered by status, private and free_slots, paginated by cursor
+        """
+        if not lobby.is_built():
+            lobby.rebuild(Room.objects.lobby_rooms())
+        etag = f'"{lobby.version()}"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        params = request.query_params
+        try:
+            cursor = int(params.get('cursor', 0))
+            size = min(int(params.get('page_size', self.page_size)), self.max_page_size)
+            room_status = int(params['status']) if 'status' in params else None
+            free_slots = int(params['free_slots']) if 'free_slots' in params else None
+        except ValueError:
+            raise serializers.ValidationError('cursor, page_size, status and free_slots must be integers')
+        private = {'true': True, 'false': False}.get(params.get('private', '').lower())
+        rooms, next_cursor = lobby.page(cursor, max(size, 1), status=room_status, private=private,
+                                        free_slots=free_slots)
+        next_url = None
+        if next_cursor is not None:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+        return Response({'next': next_url, 'results': rooms}, status=status.HTTP_200_OK, headers={'ETag': etag})
+
     def get_serializer_class(self):
         if self.action in ('list', 'retrieve'):
             return RoomSerializer
@@ -139,3 +223,18 @@ class RoomViewSet(GenericViewSet, ListModelMixin, CreateModelMixin, RetrieveMode
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class PackViewSet(GenericViewSet, ListModelMixin):
+    queryset = Pack.objects.order_by('title')
+    serializer_class = PackSerializer
+    permission_classes = [IsAuthenticated]
+
+
+def metrics(request):
+    """
+    Websocket event histograms of this process in the Prometheus text format, for staff and METRICS_ALLOWED_IPS
+    """
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4')
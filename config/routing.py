@@ -1,11 +1,13 @@
 from django.urls import re_path
 from channels.routing import ProtocolTypeRouter, URLRouter
 
-from app.core.consumers import RoomConsumer
+from app.core.consumers import RoomConsumer, LobbyConsumer
+from app.core.middleware import JWTAuthMiddleware
 
 application = ProtocolTypeRouter({
     "websocket":
         URLRouter([
-            re_path(r'game/(?P<room_name>\w+)/$', RoomConsumer),
+            re_path(r'game/(?P<room_name>\w+)/$', JWTAuthMiddleware(RoomConsumer)),
+            re_path(r'^lobby/$', JWTAuthMiddleware(LobbyConsumer)),
         ])
 })
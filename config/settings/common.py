@@ -82,7 +82,7 @@ REST_FRAMEWORK = {
     'DEFAULT_METADATA_CLASS': 'rest_framework.metadata.SimpleMetadata',
     'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'app.core.authentication.CachedJWTAuthentication',
     ],
 }
 
@@ -90,15 +90,27 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
 }
 
+REDIS_HOST = config('REDIS_HOST')
+REDIS_PORT = config('REDIS_PORT', cast=int)
+REDIS_DB = config('REDIS_DB', default=0, cast=int)
+# the tests run on this database and flush it, see app.core.runner
+REDIS_TEST_DB = config('REDIS_TEST_DB', default=15, cast=int)
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [(config('REDIS_HOST'), config('REDIS_PORT'))],
+            'hosts': [{'address': (REDIS_HOST, REDIS_PORT), 'db': REDIS_DB}],
         },
     },
 }
 
+# orjson, ujson or json, the fastest installed one if not set
+EVENT_JSON_BACKEND = config('EVENT_JSON_BACKEND', default=None)
+
+# /metrics/ is served to staff users and these addresses, e.g. the Prometheus server
+METRICS_ALLOWED_IPS = config('METRICS_ALLOWED_IPS', default='127.0.0.1', cast=Csv())
+
 WSGI_APPLICATION = 'config.wsgi.application'
 ASGI_APPLICATION = 'config.routing.application'
 
@@ -181,3 +193,21 @@ EMAIL_HOST_PASSWORD = config('EMAIL_PASSWORD')
 FRONTEND_URL = config('FRONT_URL')
 
 FIXTURE_DIRS = (os.path.join(BASE_DIR, 'fixtures'),)
+
+TEST_RUNNER = 'app.core.runner.RedisTestRunner'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'app': {
+            'handlers': ['console'],
+            'level': config('LOG_LEVEL', default='INFO'),
+        },
+    },
+}